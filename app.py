@@ -2,15 +2,78 @@
 # Carbon Footprint Calculator — Full
 # =========================
 
+from __future__ import annotations
+
 import os
 import io
+import sys
+import json
+import time
+import uuid
+import gzip
+import hashlib
+import heapq
+import pathlib
+import secrets
+import shutil
+import queue
+import random
+import asyncio
+import argparse
+import re
 import datetime
 import sqlite3
-from typing import Dict, Any
-import pandas as pd
+import logging
+import importlib
+import importlib.util
+import inspect
+import functools
+import threading
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, Any, List, Optional, Tuple
 import streamlit as st
-import matplotlib.pyplot as plt
-from openai import OpenAI
+
+logger = logging.getLogger(__name__)
+
+# -------------------- LAZY IMPORTS --------------------
+# Heavy dependencies are imported on first use, so a cold start that only renders
+# Home does not pay for pandas, matplotlib, openai or supabase.
+@st.cache_resource
+def import_timings() -> Dict[str, float]:
+    """Seconds spent on each first import in this process."""
+    return {}
+
+def timed_import(name: str):
+    # import_module also waits for a module another thread is still initializing,
+    # which a bare sys.modules lookup would hand back half-built
+    first = name not in sys.modules
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    if first:
+        import_timings()[name] = elapsed = time.perf_counter() - started
+        logger.info("Imported %s in %.1f ms", name, elapsed * 1000)
+    return module
+
+class LazyModule:
+    """Stand-in for a module that imports it on first attribute access."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = timed_import(self._name)
+        return getattr(self._module, attr)
+
+pd = LazyModule("pandas")
+np = LazyModule("numpy")
+pa = LazyModule("pyarrow")
+pads = LazyModule("pyarrow.dataset")
+pq = LazyModule("pyarrow.parquet")
+mpl_figure = LazyModule("matplotlib.figure")
 
 # -------------------- CONFIG --------------------
 st.set_page_config(page_title="Carbon Footprint Calculator — Full", page_icon="🌍", layout="wide")
@@ -34,64 +97,251 @@ SUPABASE_KEY = st.secrets.get("SUPABASE_KEY")
 
 # -------------------- OPENAI CLIENT --------------------
 OPENAI_AVAILABLE = bool(OPENAI_API_KEY)
-if OPENAI_AVAILABLE:
-    client = OpenAI(api_key=OPENAI_API_KEY)
+
+@st.cache_resource(on_release=lambda c: c and c.close())
+def get_openai_client():
+    """One OpenAI client (and its HTTP connection pool) per process, created on first use."""
+    if OPENAI_AVAILABLE:
+        return timed_import("openai").OpenAI(api_key=OPENAI_API_KEY)
+    return None
 
 # -------------------- SUPABASE --------------------
-try:
-    from supabase import create_client
-    SUPABASE_AVAILABLE = bool(SUPABASE_URL and SUPABASE_KEY)
-except Exception:
-    SUPABASE_AVAILABLE = False
+SUPABASE_AVAILABLE = bool(SUPABASE_URL and SUPABASE_KEY) and importlib.util.find_spec("supabase") is not None
 
+@st.cache_resource
 def init_supabase():
     if SUPABASE_AVAILABLE:
-        return create_client(SUPABASE_URL, SUPABASE_KEY)
+        return timed_import("supabase").create_client(SUPABASE_URL, SUPABASE_KEY)
     return None
 
 supabase = init_supabase()
 
 # -------------------- LOCAL SQLITE --------------------
-sqlite_conn = sqlite3.connect("emissions.db", check_same_thread=False)
-cur = sqlite_conn.cursor()
-# daily_emissions table
-cur.execute("""
-CREATE TABLE IF NOT EXISTS daily_emissions (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id TEXT,
-    alias TEXT,
-    date TEXT,
-    transport_mode TEXT,
-    distance REAL,
-    electricity REAL,
-    lpg REAL,
-    transport_emission REAL,
-    electricity_emission REAL,
-    lpg_emission REAL,
-    total_emission REAL,
-    notes TEXT
-);
-""")
-# user goals
-cur.execute("""
-CREATE TABLE IF NOT EXISTS user_goals (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id TEXT,
-    weekly_target REAL
-);
-""")
-# leaderboard aliases
-cur.execute("""
-CREATE TABLE IF NOT EXISTS leaderboard_aliases (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id TEXT,
-    alias TEXT
-);
-""")
-sqlite_conn.commit()
+DB_PATH = "emissions.db"
+
+def create_base_tables(conn: sqlite3.Connection):
+    cur = conn.cursor()
+    # daily_emissions table
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS daily_emissions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT,
+        alias TEXT,
+        date TEXT,
+        transport_mode TEXT,
+        distance REAL,
+        electricity REAL,
+        lpg REAL,
+        transport_emission REAL,
+        electricity_emission REAL,
+        lpg_emission REAL,
+        total_emission REAL,
+        notes TEXT
+    );
+    """)
+    # user goals
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_goals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT,
+        weekly_target REAL
+    );
+    """)
+    # leaderboard aliases
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS leaderboard_aliases (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT,
+        alias TEXT
+    );
+    """)
+    # idempotency key shared by the local row and its Supabase copy
+    if 'idempotency_key' not in [r[1] for r in cur.execute("PRAGMA table_info(daily_emissions)")]:
+        cur.execute("ALTER TABLE daily_emissions ADD COLUMN idempotency_key TEXT")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_daily_emissions_idempotency_key ON daily_emissions (idempotency_key)")
+    # outbox of records waiting to be pushed to Supabase
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS supabase_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        idempotency_key TEXT UNIQUE,
+        payload TEXT,
+        attempts INTEGER DEFAULT 0,
+        next_attempt_at REAL DEFAULT 0,
+        last_error TEXT,
+        created_at REAL
+    );
+    """)
+    # tips prepared per user by the batch job
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ai_tips (
+        user_key TEXT PRIMARY KEY,
+        model TEXT,
+        tips TEXT,
+        created_at REAL
+    );
+    """)
+    # how far each user's rows have been pulled from Supabase
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS supabase_mirror_state (
+        scope TEXT PRIMARY KEY,
+        remote_cursor INTEGER DEFAULT 0,
+        synced_at REAL
+    );
+    """)
+    # AI tips by model and normalized prompt
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ai_tips_cache (
+        cache_key TEXT PRIMARY KEY,
+        model TEXT,
+        tips TEXT,
+        created_at REAL
+    );
+    """)
+    conn.commit()
+
+# -------------------- HISTORY VERSIONS --------------------
+# A data version per user, shared by every session in the process. Writes bump it,
+# and caches of query results and rendered output (charts, exports) key on it, so they
+# miss once the underlying rows change.
+ALL_USERS_KEY = '*'
+
+class HistoryVersions:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions: Dict[str, int] = {}
+
+    def version(self, key: str) -> int:
+        with self._lock:
+            return self._versions.get(key, 0)
+
+    def bump(self, user_ids):
+        """Invalidate the given users, and the all-users view that contains them."""
+        with self._lock:
+            for key in {ALL_USERS_KEY, *(u for u in user_ids if u)}:
+                self._versions[key] = self._versions.get(key, 0) + 1
+
+@st.cache_resource
+def history_versions() -> HistoryVersions:
+    return HistoryVersions()
+
+def versioned_read(fn):
+    """Share fn's result between sessions until the data version of its user_id changes.
+
+    Results are shared: treat returned frames as read-only.
+    """
+    signature = inspect.signature(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        user_key = bound.arguments['user_id'] or ALL_USERS_KEY
+        key = (fn.__name__, history_versions().version(user_key), *bound.arguments.items())
+        return history_reads().get(key, lambda: fn(*args, **kwargs))
+    return wrapper
+
+# -------------------- ROLLUPS --------------------
+# Per-bucket aggregates kept current by AFTER INSERT triggers, so insert_local and the
+# bulk import path both maintain them inside their own transaction. Pages read these
+# instead of re-grouping the full history. Missing user ids are stored as '' so that
+# ON CONFLICT can match them.
+ROLLUP_MEASURES = ['distance', 'electricity', 'lpg', 'transport_emission', 'electricity_emission',
+                   'lpg_emission', 'total_emission']
+WEEK_START_SQL = "date({r}.date, '-' || ((CAST(strftime('%w', {r}.date) AS INTEGER) + 6) % 7) || ' days')"
+ROLLUPS = {
+    # table: (primary key column, expr, second primary key column, expr, row filter)
+    'rollup_user_daily': ('user_key', "COALESCE({r}.user_id, '')", 'day', "date({r}.date)", None),
+    'rollup_user_weekly': ('user_key', "COALESCE({r}.user_id, '')", 'week_start', WEEK_START_SQL, None),
+    'rollup_user_monthly': ('user_key', "COALESCE({r}.user_id, '')", 'month', "substr({r}.date, 1, 7)", None),
+    # per alias per day, keyed by day first: the leaderboard reads a rolling 7-day range,
+    # which ISO-week buckets cannot answer exactly
+    'rollup_alias_daily': ('day', "date({r}.date)", 'alias', "{r}.alias", "{r}.alias IS NOT NULL"),
+}
+# rows whose date SQLite cannot read have no bucket and stay out of every rollup
+ROLLUP_DATE_FILTER = "date({r}.date) IS NOT NULL"
+
+def ensure_rollups(conn: sqlite3.Connection):
+    """Create rollup tables and triggers, backfilling any table that did not exist yet."""
+    existing = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    updates = ", ".join(["entries = entries + excluded.entries"] + [f"{m} = {m} + excluded.{m}" for m in ROLLUP_MEASURES])
+    with conn:
+        for table, (key, key_expr, bucket, bucket_expr, where) in ROLLUPS.items():
+            where = " AND ".join(f"({w})" for w in (ROLLUP_DATE_FILTER, where) if w)
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    {key} TEXT NOT NULL,
+                    {bucket} TEXT NOT NULL,
+                    entries INTEGER NOT NULL DEFAULT 0,
+                    {', '.join(f'{m} REAL NOT NULL DEFAULT 0' for m in ROLLUP_MEASURES)},
+                    PRIMARY KEY ({key}, {bucket})
+                )
+            """)
+            conn.execute(f"DROP TRIGGER IF EXISTS trg_{table}")
+            conn.execute(f"""
+                CREATE TRIGGER trg_{table} AFTER INSERT ON daily_emissions
+                WHEN {where.format(r='NEW')}
+                BEGIN
+                    INSERT INTO {table} ({key}, {bucket}, entries, {', '.join(ROLLUP_MEASURES)})
+                    VALUES ({key_expr.format(r='NEW')}, {bucket_expr.format(r='NEW')}, 1,
+                            {', '.join(f'COALESCE(NEW.{m}, 0)' for m in ROLLUP_MEASURES)})
+                    ON CONFLICT ({key}, {bucket}) DO UPDATE SET {updates};
+                END
+            """)
+            if table not in existing:
+                r = 'daily_emissions'
+                conn.execute(f"""
+                    INSERT INTO {table} ({key}, {bucket}, entries, {', '.join(ROLLUP_MEASURES)})
+                    SELECT {key_expr.format(r=r)}, {bucket_expr.format(r=r)}, COUNT(*),
+                           {', '.join(f'SUM(COALESCE({m}, 0))' for m in ROLLUP_MEASURES)}
+                    FROM daily_emissions
+                    WHERE {where.format(r=r)}
+                    GROUP BY 1, 2
+                """)
+
+def user_rollup_sql(period: str) -> str:
+    """Buckets of one user's rollup table, oldest first."""
+    table = f'rollup_user_{period}'
+    bucket = ROLLUPS[table][2]
+    measures = ['entries'] + ROLLUP_MEASURES
+    return f"SELECT {bucket}, {', '.join(measures)} FROM {table} WHERE user_key = ? ORDER BY {bucket} ASC"
+
+@versioned_read
+def fetch_user_rollup(period: str, user_id=None) -> pd.DataFrame:
+    """Buckets of one user rollup ('daily', 'weekly' or 'monthly'), oldest first.
+
+    Without a user id the buckets of every user are summed.
+    """
+    table = f'rollup_user_{period}'
+    bucket = ROLLUPS[table][2]
+    measures = ['entries'] + ROLLUP_MEASURES
+    if user_id:
+        return pd.read_sql_query(user_rollup_sql(period), sqlite_conn, params=(user_id,))
+    sums = ", ".join(f"SUM({m}) AS {m}" for m in measures)
+    return pd.read_sql_query(f"SELECT {bucket}, {sums} FROM {table} GROUP BY {bucket} ORDER BY {bucket} ASC", sqlite_conn)
 
 # -------------------- HELPERS --------------------
+TRANSPORT_MODES = list(EMISSION_FACTORS)
+
+def compute_emissions_array(distance_km, transport_mode, electricity_kwh, lpg_kg) -> Dict[str, Any]:
+    """Emissions for arrays or Series of inputs, all four columns in one pass.
+
+    Modes are mapped to factors through their categorical codes; unknown modes get
+    code -1, which indexes the trailing 0.0 of the lookup table.
+    """
+    factors = np.array([EMISSION_FACTORS[m] for m in TRANSPORT_MODES] + [0.0])
+    codes = pd.Categorical(np.asarray(transport_mode, dtype=object), categories=TRANSPORT_MODES).codes
+    t_e = np.asarray(distance_km, dtype=float) * factors[codes]
+    e_e = np.asarray(electricity_kwh, dtype=float) * ELECTRICITY_FACTOR
+    l_e = np.asarray(lpg_kg, dtype=float) * LPG_FACTOR
+    return {
+        "transport_emission": t_e,
+        "electricity_emission": e_e,
+        "lpg_emission": l_e,
+        "total_emission": t_e + e_e + l_e
+    }
+
 def compute_emissions(distance_km, transport_mode, electricity_kwh, lpg_kg):
+    # plain arithmetic: one form entry costs ~1µs here against ~240µs through the array path
     tf = EMISSION_FACTORS.get(transport_mode, 0.0)
     t_e = float(distance_km) * float(tf)
     e_e = float(electricity_kwh) * float(ELECTRICITY_FACTOR)
@@ -104,38 +354,1327 @@ def compute_emissions(distance_km, transport_mode, electricity_kwh, lpg_kg):
         "total_emission": total
     }
 
-# Insert local
+EMISSION_COLUMNS = ['user_id', 'alias', 'date', 'transport_mode', 'distance', 'electricity', 'lpg',
+                    'transport_emission', 'electricity_emission', 'lpg_emission', 'total_emission', 'notes',
+                    'idempotency_key']
+INSERT_EMISSION_SQL = f"""
+    INSERT INTO daily_emissions ({', '.join(EMISSION_COLUMNS)})
+    VALUES ({', '.join('?' for _ in EMISSION_COLUMNS)})
+"""
+INSERT_OUTBOX_SQL = "INSERT OR IGNORE INTO supabase_outbox (idempotency_key, payload, created_at) VALUES (?, ?, ?)"
+
+KEY_LOOKUP_CHUNK = 500
+
+def _insert_emissions_job(conn: sqlite3.Connection, rows: List[tuple], outbox_rows: List[tuple]) -> List[Optional[int]]:
+    """Insert rows whose idempotency_key is not stored yet; returns each row's new id, or None if skipped."""
+    keys = [r[-1] for r in rows]
+    existing = set()
+    for i in range(0, len(keys), KEY_LOOKUP_CHUNK):
+        part = keys[i:i + KEY_LOOKUP_CHUNK]
+        existing.update(k for (k,) in conn.execute(
+            f"SELECT idempotency_key FROM daily_emissions WHERE idempotency_key IN ({', '.join('?' for _ in part)})", part))
+    fresh = []
+    for pos, key in enumerate(keys):
+        if key not in existing:
+            existing.add(key)
+            fresh.append(pos)
+    conn.executemany(INSERT_EMISSION_SQL, [rows[pos] for pos in fresh])
+    ids: List[Optional[int]] = [None] * len(rows)
+    if fresh:
+        first_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0] - len(fresh) + 1
+        for offset, pos in enumerate(fresh):
+            ids[pos] = first_id + offset  # one executemany hands out consecutive ids
+    conn.executemany(INSERT_OUTBOX_SQL, [outbox_rows[pos] for pos in fresh] if outbox_rows else [])
+    return ids
+
+# Insert local (and queue for Supabase when configured)
 def insert_local(record: Dict[str, Any]):
-    cur = sqlite_conn.cursor()
-    cur.execute("""
-        INSERT INTO daily_emissions (user_id, alias, date, transport_mode, distance, electricity, lpg,
-            transport_emission, electricity_emission, lpg_emission, total_emission, notes)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        record.get('user_id'), record.get('alias'), record.get('date'), record.get('transport_mode'), record.get('distance'),
-        record.get('electricity'), record.get('lpg'), record.get('transport_emission'), record.get('electricity_emission'),
-        record.get('lpg_emission'), record.get('total_emission'), record.get('notes')
-    ))
-    sqlite_conn.commit()
+    record = {**record, 'idempotency_key': record.get('idempotency_key') or uuid.uuid4().hex}
+    outbox_rows = [(record['idempotency_key'], json.dumps(record), time.time())] if SUPABASE_AVAILABLE else []
+    [row_id] = db_write(_insert_emissions_job, [tuple(record.get(c) for c in EMISSION_COLUMNS)], outbox_rows)
+    if row_id is None:
+        return  # already stored under this idempotency_key
+    history_versions().bump([record.get('user_id')])
+    leaderboard_engine().record([(row_id, record.get('date'), record.get('alias'), record.get('total_emission'))])
+    wake_outbox_flusher()
+
+def insert_local_bulk(records: pd.DataFrame):
+    """Insert a prepared frame in a single transaction with one executemany.
+
+    Rows whose idempotency_key is already stored are skipped; returns the number inserted.
+    """
+    rows = records.reindex(columns=EMISSION_COLUMNS).astype(object)
+    missing_keys = rows['idempotency_key'].isna()
+    rows.loc[missing_keys, 'idempotency_key'] = [uuid.uuid4().hex for _ in range(int(missing_keys.sum()))]
+    rows = rows.where(rows.notna(), None)
+    outbox_rows = []
+    if SUPABASE_AVAILABLE and len(rows):
+        now = time.time()
+        payloads = rows.to_json(orient='records', lines=True).splitlines()
+        outbox_rows = [(k, p, now) for k, p in zip(rows['idempotency_key'], payloads)]
+    ids = pd.Series(db_write(_insert_emissions_job, list(rows.itertuples(index=False, name=None)), outbox_rows),
+                    index=rows.index, dtype=object)
+    rows = rows[ids.notna()]
+    if rows.empty:
+        return 0
+    history_versions().bump(rows['user_id'].unique())
+    leaderboard_engine().record(zip(ids[rows.index], rows['date'], rows['alias'], rows['total_emission']))
+    wake_outbox_flusher()
+    return len(rows)
+
+SELECT_USER_HISTORY_SQL = "SELECT * FROM daily_emissions WHERE user_id=? ORDER BY date ASC, id ASC"
+SELECT_ALL_HISTORY_SQL = "SELECT * FROM daily_emissions ORDER BY date ASC, id ASC"
+
+# -------------------- QUERIES --------------------
+# Filtering and aggregation run in SQL over the rollup tables; only final numbers come back.
+# without the hint the planner walks the whole primary key to avoid sorting for DISTINCT
+ACTIVE_USERS_SQL = """
+    SELECT DISTINCT user_key FROM rollup_user_daily INDEXED BY idx_rollup_user_daily_day
+    WHERE day >= ? AND user_key != ''
+"""
+WEEKLY_TOTAL_SQL = "SELECT COALESCE(SUM(total_emission), 0) FROM rollup_user_daily WHERE user_key = ? AND day BETWEEN ? AND ?"
+WEEKLY_TOTAL_ALL_SQL = "SELECT COALESCE(SUM(total_emission), 0) FROM rollup_user_daily WHERE day BETWEEN ? AND ?"
+EMISSION_TOTALS_SQL = "SELECT COALESCE(SUM(total_emission), 0), COALESCE(SUM(entries), 0) FROM rollup_user_monthly WHERE user_key = ?"
+EMISSION_TOTALS_ALL_SQL = "SELECT COALESCE(SUM(total_emission), 0), COALESCE(SUM(entries), 0) FROM rollup_user_monthly"
+RECENT_DAILY_TOTALS_SQL = "SELECT day, total_emission FROM rollup_user_daily WHERE user_key = ? ORDER BY day DESC LIMIT ?"
+RECENT_DAILY_TOTALS_ALL_SQL = "SELECT day, SUM(total_emission) FROM rollup_user_daily GROUP BY day ORDER BY day DESC LIMIT ?"
+USER_GOAL_SQL = "SELECT weekly_target FROM user_goals WHERE user_id=?"
+
+@versioned_read
+def weekly_total(user_id, start: datetime.date, end: datetime.date) -> float:
+    """Total kg CO2 logged between start and end (inclusive)."""
+    if user_id:
+        row = sqlite_conn.execute(WEEKLY_TOTAL_SQL, (user_id, start.isoformat(), end.isoformat())).fetchone()
+    else:
+        row = sqlite_conn.execute(WEEKLY_TOTAL_ALL_SQL, (start.isoformat(), end.isoformat())).fetchone()
+    return row[0]
+
+@versioned_read
+def emission_totals(user_id) -> Tuple[float, int]:
+    """(total kg CO2, number of entries) over a user's whole history."""
+    if user_id:
+        return sqlite_conn.execute(EMISSION_TOTALS_SQL, (user_id,)).fetchone()
+    return sqlite_conn.execute(EMISSION_TOTALS_ALL_SQL).fetchone()
+
+@versioned_read
+def recent_daily_totals(user_id, days: int = 7) -> List[Tuple[str, float]]:
+    """(day, total kg CO2) for the most recent days with entries, oldest first."""
+    if user_id:
+        rows = sqlite_conn.execute(RECENT_DAILY_TOTALS_SQL, (user_id, days)).fetchall()
+    else:
+        rows = sqlite_conn.execute(RECENT_DAILY_TOTALS_ALL_SQL, (days,)).fetchall()
+    return rows[::-1]
+
+# -------------------- LEADERBOARD ENGINE --------------------
+# Per-alias totals for the rolling window, kept in memory. Each day in the window (and
+# any future-dated day) has a bucket of per-alias totals; inserts add to their day's
+# bucket and to the running totals, and when the date rolls over the expired buckets
+# are subtracted. Reads serve a cached top-K, rebuilt with a heap only after a change.
+LEADERBOARD_WINDOW_DAYS = 7
+LEADERBOARD_SIZE = 10
+LEADERBOARD_SEED_SQL = "SELECT day, alias, total_emission, entries FROM rollup_alias_daily WHERE day >= ?"
+
+class RollingLeaderboard:
+    def __init__(self, window_days: int = LEADERBOARD_WINDOW_DAYS):
+        self.window_days = window_days
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, Dict[str, List]] = {}  # day -> alias -> [total, entries]
+        self._totals: Dict[str, List] = {}  # alias -> [total, entries] over the window
+        self._start = self._end = ''
+        self._high_water = 0  # rows up to this id were counted by the seed
+        self._top: Optional[List[Tuple[str, float]]] = None
+
+    def seed(self, conn: sqlite3.Connection, today: Optional[datetime.date] = None):
+        """Load every bucket from the window start onwards from rollup_alias_daily."""
+        start, end = self._window(today)
+        conn.execute("BEGIN")  # one snapshot for the rollup and the id high-water mark
+        try:
+            rows = conn.execute(LEADERBOARD_SEED_SQL, (start,)).fetchall()
+            high_water = conn.execute("SELECT COALESCE(MAX(id), 0) FROM daily_emissions").fetchone()[0]
+        finally:
+            conn.execute("COMMIT")
+        with self._lock:
+            self._buckets, self._totals, self._top = {}, {}, None
+            self._start, self._end, self._high_water = start, end, high_water
+            for day, alias, total, entries in rows:
+                self._add(day, alias, total, entries)
+
+    def record(self, rows):
+        """Count freshly inserted (id, date, alias, total_emission) rows."""
+        with self._lock:
+            self._advance(datetime.date.today())
+            for row_id, day, alias, total in rows:
+                if row_id <= self._high_water or alias is None or day is None:
+                    continue  # counted by the seed, or not on the leaderboard
+                self._add(str(day)[:10], alias, total or 0.0, 1)
+
+    def top(self, limit: int = LEADERBOARD_SIZE, today: Optional[datetime.date] = None) -> List[Tuple[str, float]]:
+        """(alias, total kg CO2) of the lowest totals in the window ending today, best first."""
+        with self._lock:
+            self._advance(today or datetime.date.today())
+            if limit > LEADERBOARD_SIZE:
+                return self._rank(limit)
+            if self._top is None:
+                self._top = self._rank(LEADERBOARD_SIZE)
+            return self._top[:limit]
+
+    def _rank(self, limit: int) -> List[Tuple[str, float]]:
+        best = heapq.nsmallest(limit, ((running[0], alias) for alias, running in self._totals.items()))
+        return [(alias, total) for total, alias in best]
+
+    def _window(self, today: Optional[datetime.date]) -> Tuple[str, str]:
+        today = today or datetime.date.today()
+        return (today - datetime.timedelta(days=self.window_days - 1)).isoformat(), today.isoformat()
+
+    def _add(self, day: str, alias: str, total: float, entries: int):
+        if day < self._start:
+            return
+        bucket = self._buckets.setdefault(day, {}).setdefault(alias, [0.0, 0])
+        bucket[0] += total
+        bucket[1] += entries
+        if day <= self._end:
+            self._apply(alias, total, entries)
+
+    def _apply(self, alias: str, total: float, entries: int):
+        running = self._totals.setdefault(alias, [0.0, 0])
+        running[0] += total
+        running[1] += entries
+        if running[1] <= 0:
+            del self._totals[alias]
+        self._top = None
+
+    def _advance(self, today: datetime.date):
+        """Slide the window to end at today: expire old buckets, admit new days."""
+        start, end = self._window(today)
+        if end <= self._end:
+            return
+        for day in sorted(self._buckets):
+            if day < start:
+                if day <= self._end:
+                    for alias, (total, entries) in self._buckets[day].items():
+                        self._apply(alias, -total, -entries)
+                del self._buckets[day]
+            elif self._end < day <= end:
+                for alias, (total, entries) in self._buckets[day].items():
+                    self._apply(alias, total, entries)
+        self._start, self._end = start, end
+
+@st.cache_resource
+def leaderboard_engine() -> RollingLeaderboard:
+    get_sqlite_writer()  # the database file and schema must exist first
+    engine = RollingLeaderboard()
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, isolation_level=None)
+    try:
+        engine.seed(conn)
+    finally:
+        conn.close()
+    return engine
+
+# -------------------- SHARED RESPONSES --------------------
+# Results that are identical for every viewer are computed once per process. Once an
+# entry's TTL has passed it is still served while a single background thread
+# recomputes it, and sessions that miss together wait on one computation. Caches keyed
+# per user keep only the SHARED_CACHE_ENTRIES most recently used keys.
+LEADERBOARD_TTL_SECONDS = float(st.secrets.get("LEADERBOARD_TTL_SECONDS", 15))
+SHARED_CACHE_ENTRIES = 1024
+SHARED_WAIT_SECONDS = 120.0
+
+class SharedResponseCache:
+    def __init__(self, ttl: float, max_entries: int = SHARED_CACHE_ENTRIES, wait_timeout: float = SHARED_WAIT_SECONDS):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.wait_timeout = wait_timeout  # how long a caller waits on another's computation
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()  # key -> (value, expires at), least recently used first
+        self._inflight: Dict[Any, Future] = {}
+
+    def get(self, key, compute):
+        """The cached value of key, calling compute() on a miss or in the background once stale."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if entry[1] > time.monotonic():
+                    return entry[0]
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if entry is not None:
+            if owner:
+                threading.Thread(target=self._refresh, args=(key, compute, future),
+                                 name=f"refresh-{key}", daemon=True).start()
+            return entry[0]
+        if owner:
+            self._refresh(key, compute, future)
+        return future.result(self.wait_timeout)
 
-def fetch_all_local_for_user(user_id=None):
+    def _refresh(self, key, compute, future: Future):
+        try:
+            value = compute()
+        except BaseException as e:
+            # a script stopped by a rerun raises a BaseException; waiters get a plain error
+            logger.warning("Refreshing %s failed: %r", key, e)
+            future.set_exception(e if isinstance(e, Exception) else RuntimeError("Refresh was cancelled"))
+            if not isinstance(e, Exception):
+                raise
+            return
+        else:
+            with self._lock:
+                self._entries[key] = (value, time.monotonic() + self.ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            future.set_result(value)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+@st.cache_resource
+def shared_responses() -> SharedResponseCache:
+    return SharedResponseCache(LEADERBOARD_TTL_SECONDS)
+
+@st.cache_resource
+def history_reads() -> SharedResponseCache:
+    """Query results keyed on the data version (see versioned_read), so they never expire."""
+    return SharedResponseCache(float('inf'))
+
+def leaderboard_table(limit: int = LEADERBOARD_SIZE) -> pd.DataFrame:
+    """The public leaderboard as shown on the page; shared between sessions, treat as read-only."""
+    return shared_responses().get(
+        ('leaderboard', limit),
+        lambda: pd.DataFrame(leaderboard_engine().top(limit), columns=['alias', 'weekly_total_kgCO2'])
+    )
+
+# -------------------- HISTORY PAGES --------------------
+# The history table is paged newest first with a (date, id) keyset instead of
+# shipping every row to the browser. Every page merges the hot table with the Parquet
+# archive: rows pulled from Supabase later can be older than archived ones.
+HISTORY_PAGE_ROWS = 50
+HISTORY_PAGE_COLUMNS = ['id', 'date', 'alias', 'distance', 'electricity', 'lpg', 'total_emission']
+USER_HISTORY_PAGE_SQL = f"""
+    SELECT {', '.join(HISTORY_PAGE_COLUMNS)} FROM daily_emissions
+    WHERE user_id = ? AND (date, id) < (?, ?) ORDER BY date DESC, id DESC LIMIT ?
+"""
+ALL_HISTORY_PAGE_SQL = f"""
+    SELECT {', '.join(HISTORY_PAGE_COLUMNS)} FROM daily_emissions
+    WHERE (date, id) < (?, ?) ORDER BY date DESC, id DESC LIMIT ?
+"""
+FIRST_PAGE_CURSOR = ('9999-12-31', 2 ** 63 - 1)
+
+@versioned_read
+def fetch_history_page(user_id, cursor: Tuple[str, int] = FIRST_PAGE_CURSOR,
+                       limit: int = HISTORY_PAGE_ROWS) -> pd.DataFrame:
+    """Up to `limit` rows ordered by (date, id) descending, strictly after `cursor`.
+
+    Pass the (date, id) of the last row shown to get the next page.
+    """
     if user_id:
-        df = pd.read_sql_query("SELECT * FROM daily_emissions WHERE user_id=? ORDER BY date ASC", sqlite_conn, params=(user_id,))
+        page = pd.read_sql_query(USER_HISTORY_PAGE_SQL, sqlite_conn, params=(user_id, *cursor, limit))
     else:
-        df = pd.read_sql_query("SELECT * FROM daily_emissions ORDER BY date ASC", sqlite_conn)
-    if not df.empty:
-        df['date'] = pd.to_datetime(df['date']).dt.date
-    return df
+        page = pd.read_sql_query(ALL_HISTORY_PAGE_SQL, sqlite_conn, params=(*cursor, limit))
+    # a full hot page bounds how old an archived row can be and still make the page
+    since = _archive_bound(page['date'].iloc[-1]) if len(page) == limit else None
+    archived = read_archive(user_id, columns=HISTORY_PAGE_COLUMNS, since=since, until=_archive_bound(cursor[0]))
+    if archived.empty:
+        return page
+    date, row_id = cursor
+    archived = archived[(archived['date'] < date) | ((archived['date'] == date) & (archived['id'] < row_id))]
+    merged = pd.concat([page, archived], ignore_index=True) if len(page) else archived
+    merged = merged.drop_duplicates('id')  # rows of an interrupted archive run are in both tiers
+    return merged.sort_values(['date', 'id'], ascending=False).head(limit).reset_index(drop=True)
+
+def _archive_bound(value) -> Optional[datetime.date]:
+    day = iso_day(value)
+    return datetime.date.fromisoformat(day) if day else None
+
+# -------------------- SCHEMA MIGRATIONS --------------------
+# Applied in order on top of the base tables; PRAGMA user_version records how many
+# have run. SQLite has no INCLUDE clause, so covering indexes carry the emission
+# columns as trailing key columns.
+SCHEMA_MIGRATIONS = [
+    [
+        "CREATE INDEX IF NOT EXISTS idx_daily_emissions_user_date ON daily_emissions (user_id, date)",
+        "CREATE INDEX IF NOT EXISTS idx_daily_emissions_date_alias ON daily_emissions (date, alias, total_emission)",
+        """CREATE INDEX IF NOT EXISTS idx_daily_emissions_date ON daily_emissions
+           (date, user_id, transport_emission, electricity_emission, lpg_emission, total_emission)""",
+        "CREATE INDEX IF NOT EXISTS idx_user_goals_user ON user_goals (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_leaderboard_aliases_user ON leaderboard_aliases (user_id)",
+    ],
+    [
+        # delta loads by high-water mark: WHERE user_id=? AND id > ?
+        "CREATE INDEX IF NOT EXISTS idx_daily_emissions_user_id ON daily_emissions (user_id, id)",
+    ],
+    [
+        # keyset pagination over everyone's history: ORDER BY date DESC, id DESC
+        "CREATE INDEX IF NOT EXISTS idx_daily_emissions_date_id ON daily_emissions (date, id)",
+    ],
+    [
+        # users active since a day, for the batch tips job
+        "CREATE INDEX IF NOT EXISTS idx_rollup_user_daily_day ON rollup_user_daily (day, user_key)",
+    ],
+    [
+        # sync engine: one row per user, versioned by (updated_at, origin), local changes logged
+        "CREATE TABLE IF NOT EXISTS sync_meta (key TEXT PRIMARY KEY, value TEXT)",
+        "INSERT OR IGNORE INTO sync_meta (key, value) VALUES ('origin', lower(hex(randomblob(16))))",
+        "CREATE TABLE IF NOT EXISTS sync_changelog (seq INTEGER PRIMARY KEY AUTOINCREMENT, table_name TEXT NOT NULL, row_key TEXT NOT NULL)",
+        *[sql for table in ('user_goals', 'leaderboard_aliases') for sql in (
+            # keep the newest row per user; the others are copied aside, not lost
+            f"CREATE TABLE IF NOT EXISTS {table}_dedup_backup AS SELECT * FROM {table} WHERE 0",
+            f"INSERT INTO {table}_dedup_backup SELECT * FROM {table} WHERE id NOT IN (SELECT MAX(id) FROM {table} GROUP BY user_id)",
+            f"DELETE FROM {table} WHERE id NOT IN (SELECT MAX(id) FROM {table} GROUP BY user_id)",
+            f"ALTER TABLE {table} ADD COLUMN updated_at REAL",
+            f"ALTER TABLE {table} ADD COLUMN origin TEXT",
+            f"UPDATE {table} SET updated_at = 0, origin = (SELECT value FROM sync_meta WHERE key = 'origin')",
+            f"DROP INDEX IF EXISTS idx_{table}_user",
+            f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_user_id ON {table} (user_id)",
+            f"INSERT INTO sync_changelog (table_name, row_key) SELECT '{table}', user_id FROM {table} WHERE user_id IS NOT NULL",
+            *[f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_sync_{event.lower()} AFTER {event} ON {table}
+                  WHEN NEW.user_id IS NOT NULL AND NEW.origin = (SELECT value FROM sync_meta WHERE key = 'origin')
+                  BEGIN INSERT INTO sync_changelog (table_name, row_key) VALUES ('{table}', NEW.user_id); END"""
+              for event in ('INSERT', 'UPDATE')],
+        )],
+    ],
+    [
+        # outbox rows Supabase keeps rejecting stop being retried
+        "ALTER TABLE supabase_outbox ADD COLUMN failed_at REAL",
+    ],
+]
+
+def migrate_schema(conn: sqlite3.Connection):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, statements in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+        with conn:
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {number}")
+        logger.info("Applied schema migration %d", number)
+    if version < len(SCHEMA_MIGRATIONS):
+        # refresh planner statistics for the new indexes
+        conn.execute("ANALYZE")
+
+# Every query a page runs per render, with representative parameters; tests/test_query_plans.py
+# checks that none of them falls back to a full table scan.
+HOT_QUERIES = {
+    'user history': (SELECT_USER_HISTORY_SQL, ('user',)),
+    'user history page': (USER_HISTORY_PAGE_SQL, ('user', '9999-12-31', 0, 50)),
+    'all history page': (ALL_HISTORY_PAGE_SQL, ('9999-12-31', 0, 50)),
+    **{f'user {period} rollup': (user_rollup_sql(period), ('user',)) for period in ('daily', 'weekly', 'monthly')},
+    'weekly total': (WEEKLY_TOTAL_SQL, ('user', '2024-01-01', '2024-01-07')),
+    'leaderboard seed': (LEADERBOARD_SEED_SQL, ('2024-01-01',)),
+    'emission totals': (EMISSION_TOTALS_SQL, ('user',)),
+    'recent daily totals': (RECENT_DAILY_TOTALS_SQL, ('user', 7)),
+    'active users': (ACTIVE_USERS_SQL, ('2024-01-01',)),
+    'user goal': (USER_GOAL_SQL, ('user',)),
+}
+
+def find_full_scans(conn: sqlite3.Connection) -> List[str]:
+    """Run EXPLAIN QUERY PLAN over HOT_QUERIES and report full table scans and row sorts.
+
+    Sorting the output of a GROUP BY is expected: it only touches one row per group.
+    """
+    problems = []
+    for name, (sql, params) in HOT_QUERIES.items():
+        grouped = 'GROUP BY' in sql.upper()
+        for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+            detail = row[-1]
+            if detail.startswith('SCAN ') or ('TEMP B-TREE FOR ORDER BY' in detail and not grouped):
+                problems.append(f"{name}: {detail}")
+    return problems
+
+# -------------------- RESOURCES --------------------
+# Streamlit re-executes this script on every interaction; the writer (which owns the
+# schema bootstrap) lives in the resource cache so it happens once per process.
+def bootstrap_schema(conn: sqlite3.Connection):
+    create_base_tables(conn)
+    ensure_rollups(conn)
+    migrate_schema(conn)
+
+# -------------------- SQLITE WRITER --------------------
+# One thread owns the only write connection and drains a queue of jobs. Jobs that
+# arrive together share one transaction (group commit), each inside its own
+# savepoint so a failing job does not take the others down. Sessions read through
+# their own read-only connections; WAL lets those reads run beside the writer.
+WRITE_BATCH_MAX = 256
+
+class SQLiteWriter:
+    def __init__(self, path: str):
+        self.path = path
+        self._jobs: queue.Queue = queue.Queue()
+        self._ready = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error:
+            raise self._error
+
+    def submit(self, job, *args) -> Future:
+        """Queue job(conn, *args); the future resolves once its transaction commits."""
+        future = Future()
+        self._jobs.put((future, job, args))
+        return future
+
+    def execute(self, job, *args, timeout: float = 30.0):
+        return self.submit(job, *args).result(timeout)
+
+    def is_alive(self) -> bool:
+        return self._thread.is_alive()
+
+    def stop(self):
+        self._jobs.put(None)
+        self._thread.join(timeout=5)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        bootstrap_schema(conn)
+        return conn
+
+    def _run(self):
+        try:
+            conn = self._connect()
+        except Exception as e:
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        while True:
+            item = self._jobs.get()
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= WRITE_BATCH_MAX:
+                    break
+                try:
+                    item = self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._commit_batch(conn, batch)
+            if item is None:
+                conn.close()
+                return
+
+    def _commit_batch(self, conn: sqlite3.Connection, batch):
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for future, job, args in batch:
+                conn.execute("SAVEPOINT job")
+                try:
+                    outcomes.append((future, job(conn, *args), None))
+                    conn.execute("RELEASE job")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    outcomes.append((future, None, e))
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            outcomes = [(future, None, e) for future, _, _ in batch]
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+@st.cache_resource(validate=lambda writer: writer.is_alive(), on_release=lambda writer: writer.stop())
+def get_sqlite_writer() -> SQLiteWriter:
+    """The process-wide writer; creating it bootstraps the schema."""
+    return SQLiteWriter(DB_PATH)
+
+def db_write(job, *args):
+    """Run job(conn, *args) on the writer thread and wait for it to commit."""
+    return get_sqlite_writer().execute(job, *args)
+
+def get_sqlite_reader() -> sqlite3.Connection:
+    """This session's read-only connection."""
+    conn = st.session_state.get('_sqlite_reader')
+    if conn is None:
+        get_sqlite_writer()  # the database file and schema must exist first
+        conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+        st.session_state['_sqlite_reader'] = conn
+    return conn
+
+sqlite_conn = get_sqlite_reader()
+
+# -------------------- ASYNC I/O --------------------
+# Network calls that can run side by side go through one event loop on a background
+# thread, sharing a pooled httpx client (keep-alive, HTTP/2 when h2 is installed). Any
+# thread submits a coroutine and waits with a timeout, every request carries its own
+# timeout, and a semaphore caps how many are in flight.
+IO_CONCURRENCY = int(st.secrets.get("IO_CONCURRENCY", 8))
+IO_TIMEOUT_SECONDS = float(st.secrets.get("IO_TIMEOUT_SECONDS", 15))
+HTTPX_AVAILABLE = importlib.util.find_spec("httpx") is not None
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
 
-def insert_supabase(record: Dict[str, Any]):
+class AsyncIOLayer:
+    def __init__(self, concurrency: int = IO_CONCURRENCY, timeout: float = IO_TIMEOUT_SECONDS):
+        httpx = timed_import("httpx")
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(concurrency)
+        self.http = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE, timeout=httpx.Timeout(timeout, connect=5.0),
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency, keepalive_expiry=30.0),
+        )
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="async-io", daemon=True)
+        self._thread.start()
+
+    def submit(self, coro) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """Run coro on the loop and wait for its result; timeout=None waits self.timeout."""
+        future = self.submit(coro)
+        try:
+            return future.result(self.timeout if timeout is None else timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def is_alive(self) -> bool:
+        return self._thread.is_alive()
+
+    def close(self):
+        self.run(self.http.aclose())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+
+@st.cache_resource(validate=lambda io: io is None or io.is_alive(), on_release=lambda io: io and io.close())
+def async_io() -> Optional[AsyncIOLayer]:
+    return AsyncIOLayer() if HTTPX_AVAILABLE else None
+
+class SupabaseREST:
+    """The few Supabase endpoints called at volume, over the shared async client."""
+    def __init__(self, io: AsyncIOLayer, url: str, key: str):
+        self.io = io
+        self.url = url.rstrip('/')
+        self.headers = {'apikey': key, 'Authorization': f"Bearer {key}"}
+
+    async def _post(self, path: str, payload, params=None, prefer: Optional[str] = None, timeout: Optional[float] = None):
+        headers = {**self.headers, 'Prefer': prefer} if prefer else self.headers
+        async with self.io.slots:
+            response = await self.io.http.post(f"{self.url}{path}", json=payload, params=params, headers=headers,
+                                               timeout=timeout or self.io.timeout)
+        response.raise_for_status()
+        return response
+
+    async def upsert(self, table: str, rows: List[Dict[str, Any]], on_conflict: str):
+        """Insert rows, skipping any whose on_conflict column already exists."""
+        await self._post(f"/rest/v1/{table}", rows, params={'on_conflict': on_conflict},
+                         prefer="resolution=ignore-duplicates,return=minimal")
+
+    async def upsert_many(self, table: str, batches: List[List[Dict[str, Any]]], on_conflict: str) -> List[Optional[Exception]]:
+        """Upsert batches concurrently; the error of each batch, or None."""
+        results = await asyncio.gather(*(self.upsert(table, rows, on_conflict) for rows in batches), return_exceptions=True)
+        return [r if isinstance(r, Exception) else None for r in results]
+
+    async def send_magic_link(self, email: str):
+        await self._post("/auth/v1/otp", {'email': email, 'create_user': True})
+
+@st.cache_resource
+def supabase_rest() -> Optional[SupabaseREST]:
+    io = async_io()
+    if SUPABASE_AVAILABLE and io:
+        return SupabaseREST(io, SUPABASE_URL, SUPABASE_KEY)
+    return None
+
+# -------------------- SUPABASE OUTBOX --------------------
+# Every write lands in SQLite first; a background thread pushes the outbox to Supabase.
+# Rows are upserted on idempotency_key (a unique column on the Supabase table), so a
+# batch retried after a timeout never creates duplicates. Transient failures back off and
+# retry indefinitely; a row Supabase rejects (a 4xx, or a Postgres data, constraint or
+# schema error) is marked failed after OUTBOX_MAX_ATTEMPTS and kept for inspection.
+OUTBOX_BATCH_ROWS = 500
+OUTBOX_BATCH_BYTES = 512 * 1024
+OUTBOX_POLL_SECONDS = 5.0
+OUTBOX_BACKOFF_BASE = 2.0
+OUTBOX_BACKOFF_MAX = 300.0
+OUTBOX_MAX_ATTEMPTS = 5
+
+def fetch_outbox_batches(conn: sqlite3.Connection, now: float, max_batches: int = 1) -> List[List[tuple]]:
+    """Oldest due outbox rows split into batches, each capped by row count and payload size."""
+    rows = conn.execute(
+        "SELECT id, payload, attempts FROM supabase_outbox WHERE failed_at IS NULL AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+        (now, OUTBOX_BATCH_ROWS * max_batches)
+    ).fetchall()
+    batches, batch, size = [], [], 0
+    for row in rows:
+        if batch and (len(batch) >= OUTBOX_BATCH_ROWS or size + len(row[1]) > OUTBOX_BATCH_BYTES):
+            batches.append(batch)
+            if len(batches) == max_batches:
+                return batches
+            batch, size = [], 0
+        batch.append(row)
+        size += len(row[1])
+    if batch:
+        batches.append(batch)
+    return batches
+
+def _outbox_retry_job(conn: sqlite3.Connection, retries: List[tuple]):
+    conn.executemany(
+        "UPDATE supabase_outbox SET attempts=attempts+1, next_attempt_at=?, last_error=?, failed_at=? WHERE id=?", retries
+    )
+
+def _outbox_delete_job(conn: sqlite3.Connection, ids: List[tuple]):
+    conn.executemany("DELETE FROM supabase_outbox WHERE id=?", ids)
+
+def _push_outbox_batches(client, batches: List[List[tuple]]) -> List[Optional[Exception]]:
+    """Upsert each batch; the error of each batch, or None where it was delivered."""
+    payloads = [[json.loads(r[1]) for r in batch] for batch in batches]
+    if isinstance(client, SupabaseREST):
+        return client.io.run(client.upsert_many('daily_emissions', payloads, on_conflict='idempotency_key'),
+                             timeout=2 * client.io.timeout * -(-len(batches) // IO_CONCURRENCY))
+    errors = []
+    for rows in payloads:
+        try:
+            client.table('daily_emissions').upsert(rows, on_conflict='idempotency_key', ignore_duplicates=True).execute()
+            errors.append(None)
+        except Exception as e:
+            errors.append(e)
+    return errors
+
+def is_permanent_error(error: Exception) -> bool:
+    """Whether resending the same rows is bound to fail again."""
+    status = getattr(getattr(error, 'response', None), 'status_code', None)  # httpx.HTTPStatusError
+    if status is not None:
+        return 400 <= status < 500 and status not in (408, 429)
+    # postgrest's APIError carries the SQLSTATE: data exceptions, constraint violations, schema errors
+    return str(getattr(error, 'code', '') or '')[:2] in ('22', '23', '42')
+
+def _push_or_fail(client, batches: List[List[tuple]]) -> List[Optional[Exception]]:
+    try:
+        return _push_outbox_batches(client, batches)
+    except Exception as e:  # the whole round timed out
+        return [e] * len(batches)
+
+def flush_outbox_once(conn: sqlite3.Connection, client, writer: SQLiteWriter) -> int:
+    """Push the next due batches to Supabase, concurrently over the async client. Returns rows delivered."""
+    batches = fetch_outbox_batches(conn, time.time(), IO_CONCURRENCY if isinstance(client, SupabaseREST) else 1)
+    if not batches:
+        return 0
+    outcomes, singles = [], []
+    for batch, error in zip(batches, _push_or_fail(client, batches)):
+        if error is not None and len(batch) > 1 and is_permanent_error(error):
+            singles.extend([row] for row in batch)  # one bad row rejects its batch: resend rows one by one
+        else:
+            outcomes.append((batch, error))
+    if singles:
+        outcomes += zip(singles, _push_or_fail(client, singles))
+    now, delivered, retries = time.time(), [], []
+    for batch, error in outcomes:
+        if error is None:
+            delivered.extend((r[0],) for r in batch)
+            continue
+        permanent = is_permanent_error(error)
+        for i, _, attempts in batch:
+            failed_at = now if permanent and attempts + 1 >= OUTBOX_MAX_ATTEMPTS else None
+            backoff = min(OUTBOX_BACKOFF_BASE * 2 ** attempts, OUTBOX_BACKOFF_MAX) * random.uniform(0.5, 1.0)
+            retries.append((now + backoff, str(error), failed_at, i))
+    if retries:
+        writer.execute(_outbox_retry_job, retries)
+    if delivered:
+        writer.execute(_outbox_delete_job, delivered)
+    return len(delivered)
+
+def _outbox_flusher_loop(client, writer: SQLiteWriter, wake: threading.Event):
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+    while True:
+        wake.wait(OUTBOX_POLL_SECONDS)
+        wake.clear()
+        try:
+            while flush_outbox_once(conn, client, writer):
+                pass
+        except Exception:
+            logger.exception("Flushing the Supabase outbox failed")
+
+# A flusher thread that died is started again on the next script run.
+@st.cache_resource(validate=lambda flusher: flusher[1] is None or flusher[1].is_alive())
+def start_outbox_flusher() -> Tuple[threading.Event, Optional[threading.Thread]]:
+    """Start the single background flusher for this process; returns its wake-up event and thread."""
+    wake = threading.Event()
+    thread = None
     if supabase:
+        thread = threading.Thread(target=_outbox_flusher_loop, args=(supabase_rest() or supabase, get_sqlite_writer(), wake),
+                                  name="supabase-outbox", daemon=True)
+        thread.start()
+    return wake, thread
+
+def wake_outbox_flusher():
+    start_outbox_flusher()[0].set()
+
+start_outbox_flusher()
+
+def outbox_pending_count() -> int:
+    return sqlite_conn.execute("SELECT COUNT(*) FROM supabase_outbox WHERE failed_at IS NULL").fetchone()[0]
+
+def outbox_failed_count() -> int:
+    return sqlite_conn.execute("SELECT COUNT(*) FROM supabase_outbox WHERE failed_at IS NOT NULL").fetchone()[0]
+
+# -------------------- SUPABASE MIRROR --------------------
+# Rows saved on other instances are pulled from Supabase into the local table, so every
+# read keeps going to SQLite. Each signed-in user's rows are fetched by remote id above
+# a cursor kept in supabase_mirror_state, filtered and paged on the server. A user is
+# synced inline the first time this process sees them, then in the background at most
+# once per MIRROR_SYNC_SECONDS. Rows we pushed ourselves come back with an idempotency
+# key that already exists locally and are skipped.
+MIRROR_SYNC_SECONDS = float(st.secrets.get("MIRROR_SYNC_SECONDS", 60))
+MIRROR_PAGE_ROWS = 1000
+INSERT_MIRRORED_SQL = INSERT_EMISSION_SQL + " ON CONFLICT (idempotency_key) DO NOTHING"
+
+class SupabaseRepository:
+    """Server-side filtered, column-selected, paged reads of one remote table."""
+    def __init__(self, client, table: str = 'daily_emissions', cursor_column: str = 'id'):
+        self.client = client
+        self.table = table
+        self.cursor_column = cursor_column
+
+    def pages(self, filters: Dict[str, Any], columns: List[str], after: int = 0,
+              page_rows: int = MIRROR_PAGE_ROWS):
+        """Yield lists of rows with the cursor column above after, in its order, page_rows at a time."""
+        key = self.cursor_column
+        while True:
+            query = self.client.table(self.table).select(",".join([key] + columns))
+            for column, value in filters.items():
+                query = query.eq(column, value)
+            rows = query.gt(key, after).order(key).range(0, page_rows - 1).execute().data
+            if rows:
+                yield rows
+            if len(rows) < page_rows:
+                return
+            after = rows[-1][key]
+
+def mirror_cursor(conn: sqlite3.Connection, scope: str) -> int:
+    row = conn.execute("SELECT remote_cursor FROM supabase_mirror_state WHERE scope = ?", (scope,)).fetchone()
+    return row[0] if row else 0
+
+def _set_cursor(conn: sqlite3.Connection, scope: str, cursor: int):
+    conn.execute("""
+        INSERT INTO supabase_mirror_state (scope, remote_cursor, synced_at) VALUES (?, ?, ?)
+        ON CONFLICT (scope) DO UPDATE SET remote_cursor = excluded.remote_cursor, synced_at = excluded.synced_at
+    """, (scope, cursor, time.time()))
+
+def _mirror_rows_job(conn: sqlite3.Connection, rows: List[tuple], scope: str, cursor: int) -> List[tuple]:
+    """Insert pulled rows and advance the cursor; returns (id, date, alias, total) of new rows."""
+    inserted = []
+    for row in rows:
+        cur = conn.execute(INSERT_MIRRORED_SQL, row)
+        if cur.rowcount:
+            record = dict(zip(EMISSION_COLUMNS, row))
+            inserted.append((cur.lastrowid, record['date'], record['alias'], record['total_emission']))
+    _set_cursor(conn, scope, cursor)
+    return inserted
+
+def iso_day(value) -> Optional[str]:
+    """The YYYY-MM-DD day of a date or timestamp string, or None when it is not one."""
+    try:
+        return datetime.date.fromisoformat(str(value)[:10]).isoformat()
+    except ValueError:
+        return None
+
+def _archived_keys(user_id, days: List[str]) -> set:
+    """Idempotency keys archived here already, among the archive months of the given days."""
+    cutoff = archive_cutoff(datetime.date.today(), ARCHIVE_AFTER_MONTHS).isoformat()
+    old = [d for d in days if d < cutoff]
+    if not old:
+        return set()
+    archived = read_archive(user_id, columns=['idempotency_key'], since=datetime.date.fromisoformat(min(old)),
+                            until=datetime.date.fromisoformat(max(old)))
+    return set(archived['idempotency_key'].dropna()) if not archived.empty else set()
+
+def sync_user_mirror(user_id, repository: Optional[SupabaseRepository] = None) -> int:
+    """Pull a user's rows added remotely since the last sync. Returns how many were new here.
+
+    Without a user id every user's rows are pulled.
+    """
+    repository = repository or SupabaseRepository(supabase)
+    scope = user_id or ALL_USERS_KEY
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)  # may run off the script thread
+    try:
+        cursor = mirror_cursor(conn, scope)
+    finally:
+        conn.close()
+    pulled = 0
+    for rows in repository.pages({'user_id': user_id} if user_id else {}, EMISSION_COLUMNS, after=cursor):
+        cursor = rows[-1]['id']
+        days = [iso_day(r.get('date')) for r in rows]
+        bad = [r['id'] for r, day in zip(rows, days) if day is None]
+        if bad:
+            logger.warning("Skipping %d remote rows without a valid date: ids %s", len(bad), bad[:20])
+        skip = _archived_keys(user_id, [d for d in days if d])
+        values = []
+        for r, day in zip(rows, days):
+            if day is None or r.get('idempotency_key') in skip:
+                continue
+            r = {**r, 'date': day, 'idempotency_key': r.get('idempotency_key') or f"supabase:{r['id']}"}
+            values.append(tuple(r.get(c) for c in EMISSION_COLUMNS))
+        inserted = db_write(_mirror_rows_job, values, scope, cursor)
+        if inserted:
+            history_versions().bump({v[0] for v in values})
+            leaderboard_engine().record(inserted)
+        pulled += len(inserted)
+    if pulled:
+        logger.info("Pulled %d rows for %s from Supabase", pulled, scope)
+    return pulled
+
+@st.cache_resource
+def mirror_syncs() -> SharedResponseCache:
+    return SharedResponseCache(MIRROR_SYNC_SECONDS)
+
+def refresh_user_mirror(user_id):
+    """Make sure a signed-in user's remote rows are here, without a remote read on every render."""
+    if not (supabase and user_id):
+        return
+    try:
+        mirror_syncs().get(('mirror', user_id), lambda: sync_user_mirror(user_id))
+    except Exception as e:
+        logger.warning("Supabase sync for %s failed: %s", user_id, e)
+        st.sidebar.caption("⚠️ Could not reach Supabase; showing data saved on this instance.")
+
+# -------------------- SYNC ENGINE --------------------
+# Converges this database and Supabase in the background. daily_emissions rows are
+# immutable: they go up through the outbox and come down through the mirror (for every
+# user here), keyed on idempotency_key. user_goals and leaderboard_aliases hold one row
+# per user that can change on either side; the latest updated_at wins, ties broken by
+# the higher origin (a random id per database), on both sides.
+#
+# Local changes are numbered by sync_changelog's sequence and pushed in order; remote
+# changes are pulled above the last seen change_seq. The remote tables need user_id
+# unique plus updated_at, origin and a change_seq column that a trigger sets from a
+# sequence on every insert and update (supabase/sync.sql). updated_at is epoch seconds
+# as a double precision on both sides, so timestamps compare exactly.
+SYNC_INTERVAL_SECONDS = float(st.secrets.get("SYNC_INTERVAL_SECONDS", 30))
+SYNC_BATCH_ROWS = 500
+SYNCED_SETTINGS = {
+    # table: columns besides user_id, updated_at and origin
+    'user_goals': ['weekly_target'],
+    'leaderboard_aliases': ['alias'],
+}
+
+def _apply_settings_job(conn: sqlite3.Connection, table: str, rows: List[Dict[str, Any]], cursor: Optional[int]):
+    """Apply pulled rows where they win over the local row, and advance the pull cursor.
+
+    Where the local row is strictly newer instead it is queued for pushing, so both
+    sides converge.
+    """
+    columns = ['user_id', *SYNCED_SETTINGS[table], 'updated_at', 'origin']
+    updates = ", ".join(f"{c} = excluded.{c}" for c in columns[1:])
+    for row in rows:
+        if not row.get('user_id'):
+            continue
+        row = {**row, 'updated_at': float(row.get('updated_at') or 0.0)}
+        conn.execute(f"""
+            INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})
+            ON CONFLICT (user_id) DO UPDATE SET {updates}
+            WHERE (excluded.updated_at, COALESCE(excluded.origin, '')) > (COALESCE({table}.updated_at, 0), COALESCE({table}.origin, ''))
+        """, tuple(row.get(c) for c in columns))
+        local_ts, local_origin = conn.execute(f"SELECT updated_at, origin FROM {table} WHERE user_id = ?",
+                                              (row['user_id'],)).fetchone()
+        if (local_ts or 0.0, local_origin or '') > (row['updated_at'], row.get('origin') or ''):
+            conn.execute("INSERT INTO sync_changelog (table_name, row_key) VALUES (?, ?)", (table, row['user_id']))
+    if cursor is not None:
+        _set_cursor(conn, f"pull:{table}", cursor)
+
+def pull_settings(conn: sqlite3.Connection, client, writer: SQLiteWriter, table: str) -> int:
+    repository = SupabaseRepository(client, table, cursor_column='change_seq')
+    columns = ['user_id', *SYNCED_SETTINGS[table], 'updated_at', 'origin']
+    pulled = 0
+    for rows in repository.pages({}, columns, after=mirror_cursor(conn, f"pull:{table}")):
+        writer.execute(_apply_settings_job, table, rows, rows[-1]['change_seq'])
+        pulled += len(rows)
+    return pulled
+
+def _delete_changes_job(conn: sqlite3.Connection, last_seq: int):
+    conn.execute("DELETE FROM sync_changelog WHERE seq <= ?", (last_seq,))
+
+def push_changes(conn: sqlite3.Connection, client, writer: SQLiteWriter) -> int:
+    """Push one batch of local changes in sequence order. Returns the number of changes pushed."""
+    changes = conn.execute(
+        "SELECT seq, table_name, row_key FROM sync_changelog ORDER BY seq LIMIT ?", (SYNC_BATCH_ROWS,)
+    ).fetchall()
+    if not changes:
+        return 0
+    for table, values in SYNCED_SETTINGS.items():
+        keys = sorted({key for _, t, key in changes if t == table})
+        if not keys:
+            continue
+        columns = ['user_id', *values, 'updated_at', 'origin']
+        rows = [dict(zip(columns, r)) for r in conn.execute(
+            f"SELECT {', '.join(columns)} FROM {table} WHERE user_id IN ({', '.join('?' for _ in keys)})", keys
+        )]
+        created = client.table(table).upsert(rows, on_conflict='user_id', ignore_duplicates=True).execute().data
+        created = {r['user_id'] for r in created or []}
+        for row in rows:
+            if row['user_id'] in created:
+                continue
+            # the conflict rule is checked on the server, so a newer remote row is never overwritten
+            ts, origin = row['updated_at'], row['origin']
+            updated = client.table(table).update({c: row[c] for c in columns[1:]}).eq('user_id', row['user_id']).or_(
+                f"updated_at.lt.{ts},and(updated_at.eq.{ts},origin.lt.{origin})"
+            ).execute().data
+            if not updated:  # the remote row wins: take it
+                newer = client.table(table).select(",".join(columns)).eq('user_id', row['user_id']).execute().data
+                writer.execute(_apply_settings_job, table, newer, None)
+    writer.execute(_delete_changes_job, changes[-1][0])
+    return len(changes)
+
+def sync_once(client, writer: SQLiteWriter) -> Dict[str, int]:
+    """One full round: pull every table, then push local changes."""
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+    try:
+        counts = {'daily_emissions': sync_user_mirror(None, SupabaseRepository(client))}
+        for table in SYNCED_SETTINGS:
+            counts[table] = pull_settings(conn, client, writer, table)
+        counts['pushed'] = 0
+        while True:
+            pushed = push_changes(conn, client, writer)
+            if not pushed:
+                break
+            counts['pushed'] += pushed
+        return counts
+    finally:
+        conn.close()
+
+def _sync_loop(client, writer: SQLiteWriter, wake: threading.Event):
+    while True:
+        wake.wait(SYNC_INTERVAL_SECONDS)
+        wake.clear()
         try:
-            supabase.table('daily_emissions').insert(record).execute()
-            return True
+            counts = sync_once(client, writer)
+            if any(counts.values()):
+                logger.info("Sync: %s", counts)
         except Exception as e:
-            st.error(f"Supabase insert error: {e}")
-            return False
-    return False
+            logger.warning("Sync with Supabase failed: %s", e)
+
+@st.cache_resource
+def start_sync_engine():
+    """Start the single background sync thread for this process; returns its wake-up event."""
+    wake = threading.Event()
+    if supabase:
+        threading.Thread(target=_sync_loop, args=(supabase, get_sqlite_writer(), wake),
+                         name="supabase-sync", daemon=True).start()
+    return wake
+
+def wake_sync_engine():
+    start_sync_engine().set()
+
+start_sync_engine()
+
+# -------------------- ARCHIVE --------------------
+# Rows older than ARCHIVE_AFTER_MONTHS move out of daily_emissions into Parquet files
+# partitioned by user and month (archive/user_key=<id>/month=YYYY-MM/part-*.parquet).
+# The rollups keep their totals, and exports read both tiers (iter_history_chunks).
+# Needs the optional pyarrow dependency.
+ARCHIVE_DIR = "archive"
+ARCHIVE_AFTER_MONTHS = int(st.secrets.get("ARCHIVE_AFTER_MONTHS", 12))
+ARCHIVE_INTERVAL_SECONDS = 24 * 3600
+ARCHIVE_CHUNK_ROWS = 100_000
+ARCHIVE_AVAILABLE = importlib.util.find_spec("pyarrow") is not None
+NULL_USER_PARTITION = "\x00"
+SELECT_COLD_ROWS_SQL = "SELECT * FROM daily_emissions WHERE date < ? ORDER BY id ASC"
+
+def archive_schema():
+    text = ['user_id', 'alias', 'date', 'transport_mode', 'notes', 'idempotency_key']
+    return pa.schema([('id', pa.int64())] + [(c, pa.string() if c in text else pa.float64()) for c in EMISSION_COLUMNS])
+
+def archive_cutoff(today: datetime.date, months: int) -> datetime.date:
+    """First day of the month `months` months before today's month."""
+    year, month = divmod(today.year * 12 + today.month - 1 - months, 12)
+    return datetime.date(year, month + 1, 1)
+
+def _archive_user_dir(user_id) -> str:
+    return os.path.join(ARCHIVE_DIR, f"user_key={urllib.parse.quote(user_id or NULL_USER_PARTITION, safe='')}")
+
+def _delete_emissions_job(conn: sqlite3.Connection, ids: List[tuple]):
+    conn.executemany("DELETE FROM daily_emissions WHERE id=?", ids)
+
+def archive_cold_history(conn: sqlite3.Connection, writer: SQLiteWriter, months: int = ARCHIVE_AFTER_MONTHS,
+                         today: Optional[datetime.date] = None) -> int:
+    """Move rows dated before the cutoff into the archive. Returns the number of rows moved.
+
+    Files are written before their rows are deleted, so a crash in between leaves a
+    duplicate (dropped by id on read) rather than a gap.
+    """
+    cutoff = archive_cutoff(today or datetime.date.today(), months).isoformat()
+    schema = archive_schema()
+    moved = 0
+    for chunk in pd.read_sql_query(SELECT_COLD_ROWS_SQL, conn, params=(cutoff,), chunksize=ARCHIVE_CHUNK_ROWS):
+        users = chunk['user_id'].fillna(NULL_USER_PARTITION)
+        for (user_id, month), part in chunk.groupby([users, chunk['date'].str[:7]]):
+            directory = os.path.join(_archive_user_dir(user_id), f"month={month}")
+            os.makedirs(directory, exist_ok=True)
+            table = pa.Table.from_pandas(part[schema.names], schema=schema, preserve_index=False)
+            pq.write_table(table, os.path.join(directory, f"part-{uuid.uuid4().hex}.parquet"))
+        writer.execute(_delete_emissions_job, [(int(i),) for i in chunk['id']])
+        history_versions().bump(chunk['user_id'].dropna().unique())  # pages now read these rows from the archive
+        moved += len(chunk)
+    return moved
+
+def _archive_dataset(user_id=None):
+    """pyarrow dataset over one user's archive (everyone's without a user id), or None."""
+    root = _archive_user_dir(user_id) if user_id else ARCHIVE_DIR
+    if not ARCHIVE_AVAILABLE or not os.path.isdir(root):
+        return None
+    partitions = [('month', pa.string())] if user_id else [('user_key', pa.string()), ('month', pa.string())]
+    return pads.dataset(
+        root, format='parquet', schema=pa.schema(list(archive_schema()) + [pa.field(n, t) for n, t in partitions]),
+        partitioning=pads.partitioning(pa.schema(partitions), flavor='hive')
+    )
+
+def read_archive(user_id=None, columns: Optional[List[str]] = None, since: Optional[datetime.date] = None,
+                 until: Optional[datetime.date] = None) -> pd.DataFrame:
+    """Archived rows of one user (of everyone without a user id).
+
+    Only the requested columns are read, and `since`/`until` (inclusive) prune whole
+    month partitions before filtering rows by date.
+    """
+    dataset = _archive_dataset(user_id)
+    if dataset is None:
+        return pd.DataFrame()
+    where = None
+    if since is not None:
+        where = (pads.field('month') >= since.isoformat()[:7]) & (pads.field('date') >= since.isoformat())
+    if until is not None:
+        before = (pads.field('month') <= until.isoformat()[:7]) & (pads.field('date') <= until.isoformat())
+        where = before if where is None else where & before
+    return dataset.to_table(columns=columns or archive_schema().names, filter=where).to_pandas()
+
+def iter_archive_months(user_id=None):
+    """Archived rows one month partition at a time, oldest month first, date ordered."""
+    dataset = _archive_dataset(user_id)
+    if dataset is None:
+        return
+    months = sorted({os.path.basename(os.path.dirname(f)).split('=', 1)[1] for f in dataset.files})
+    for month in months:
+        frame = dataset.to_table(columns=archive_schema().names, filter=pads.field('month') == month).to_pandas()
+        yield frame.sort_values(['date', 'id'], kind='stable', ignore_index=True)
+
+def _archiver_loop(writer: SQLiteWriter):
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+    while True:
+        try:
+            moved = archive_cold_history(conn, writer)
+            if moved:
+                logger.info("Archived %d rows older than %d months", moved, ARCHIVE_AFTER_MONTHS)
+        except Exception:
+            logger.exception("Archive job failed")
+        time.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+@st.cache_resource
+def start_archiver() -> bool:
+    """Start the daily archive job once per process, when pyarrow is installed."""
+    if not (ARCHIVE_AVAILABLE and ARCHIVE_AFTER_MONTHS > 0):
+        return False
+    threading.Thread(target=_archiver_loop, args=(get_sqlite_writer(),), name="archiver", daemon=True).start()
+    return True
+
+start_archiver()
+
+# -------------------- EXPORT --------------------
+# History downloads are generated only when asked for, streamed from the archive and a
+# SQL cursor chunk by chunk into a file, and kept per (user, data version, format) for
+# the lifetime of the process. Files are written to the app's static/exports folder,
+# emptied when the process starts, and served from disk by Streamlit's static file
+# route (server.enableStaticServing), so a download never passes through the script's
+# memory; each file name carries a random token. Without static serving, or above Streamlit's static file size limit, the
+# file goes through st.download_button instead.
+EXPORT_CHUNK_ROWS = 20_000
+EXPORT_FORMATS = {
+    # label: (file extension, mime type, required module)
+    'CSV': ('csv', 'text/csv', None),
+    'CSV (gzip)': ('csv.gz', 'application/gzip', None),
+    'Parquet': ('parquet', 'application/vnd.apache.parquet', 'pyarrow'),
+    'Excel': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'openpyxl'),
+}
+STATIC_EXPORT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "exports")
+STATIC_EXPORT_MAX_BYTES = 200 * 1024 * 1024  # Streamlit answers 404 for larger static files
+
+def available_export_formats() -> List[str]:
+    return [label for label, (_, _, module) in EXPORT_FORMATS.items()
+            if module is None or importlib.util.find_spec(module) is not None]
+
+@st.cache_resource(on_release=lambda d: shutil.rmtree(d, ignore_errors=True))
+def export_dir() -> str:
+    """The export folder, emptied once per process: data versions start over with it."""
+    shutil.rmtree(STATIC_EXPORT_DIR, ignore_errors=True)
+    os.makedirs(STATIC_EXPORT_DIR, exist_ok=True)
+    return STATIC_EXPORT_DIR
+
+def export_url(path: str) -> Optional[str]:
+    """Relative URL serving an export file from disk, or None where static serving cannot."""
+    if not st.get_option("server.enableStaticServing") or os.path.getsize(path) > STATIC_EXPORT_MAX_BYTES:
+        return None
+    return "app/static/exports/" + pathlib.Path(os.path.relpath(path, STATIC_EXPORT_DIR)).as_posix()
+
+def iter_history_chunks(user_id):
+    """A user's full history in (date, id) order, merging the archive with the hot table.
+
+    Rows backdated into an archived month still live in the hot table, so each archived
+    month goes out together with the hot rows dated up to its last day. Downloads are
+    generated off the script thread, so this uses its own connection.
+    """
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+    try:
+        if user_id:
+            hot = pd.read_sql_query(SELECT_USER_HISTORY_SQL, conn, params=(user_id,), chunksize=EXPORT_CHUNK_ROWS)
+        else:
+            hot = pd.read_sql_query(SELECT_ALL_HISTORY_SQL, conn, chunksize=EXPORT_CHUNK_ROWS)
+        pending = None  # hot rows read ahead, date ordered
+        for month in iter_archive_months(user_id):
+            last_day = month['date'].iloc[-1]
+            while pending is None or pending.empty or (pending['date'].iloc[-1] or '') <= last_day:
+                chunk = next(hot, None)
+                if chunk is None:
+                    break
+                pending = chunk if pending is None else pd.concat([pending, chunk], ignore_index=True)
+            if pending is None or pending.empty:
+                yield month
+                continue
+            due = pending['date'].fillna('') <= last_day
+            # rows caught between an archive write and the hot-table delete exist twice
+            merged = pd.concat([month, pending[due]], ignore_index=True).drop_duplicates('id', keep='last')
+            yield merged.sort_values(['date', 'id'], kind='stable', ignore_index=True)
+            pending = pending[~due].reset_index(drop=True)
+        if pending is not None and not pending.empty:
+            yield pending
+        yield from hot
+    finally:
+        conn.close()
+
+def _write_csv(path: str, chunks, compress: bool):
+    with (gzip.open(path, 'wt', newline='') if compress else open(path, 'w', newline='')) as f:
+        header = True
+        for chunk in chunks:
+            chunk.to_csv(f, index=False, header=header)
+            header = False
+
+def _write_parquet(path: str, chunks):
+    schema = archive_schema()
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_pandas(chunk[schema.names], schema=schema, preserve_index=False))
+
+def _write_excel(path: str, chunks):
+    workbook = timed_import("openpyxl").Workbook(write_only=True)
+    sheet = workbook.create_sheet("history")
+    header = True
+    for chunk in chunks:
+        if header:
+            sheet.append(list(chunk.columns))
+            header = False
+        for row in chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None):
+            sheet.append(row)
+    workbook.save(path)
+
+def export_history(user_id, fmt: str, version: int) -> str:
+    """Path of the export file for this user, format and data version, written if missing."""
+    user_key = user_id or ALL_USERS_KEY
+    ext = EXPORT_FORMATS[fmt][0]
+    stem = hashlib.sha1(user_key.encode()).hexdigest()
+    for name in os.listdir(export_dir()):
+        if name.startswith(f"{stem}-{version}-") and name.endswith(f".{ext}"):
+            return os.path.join(export_dir(), name)
+    path = os.path.join(export_dir(), f"{stem}-{version}-{secrets.token_urlsafe(16)}.{ext}")
+    partial = f"{path}.{uuid.uuid4().hex}.partial"
+    chunks = iter_history_chunks(user_id)
+    if ext == 'parquet':
+        _write_parquet(partial, chunks)
+    elif ext == 'xlsx':
+        _write_excel(partial, chunks)
+    else:
+        _write_csv(partial, chunks, compress=ext.endswith('.gz'))
+    os.replace(partial, path)
+    # this user's exports of older versions, in any format, are stale now
+    for name in os.listdir(export_dir()):
+        current = name.startswith(f"{stem}-{version}-") and not name.endswith(f".{ext}")
+        if name.startswith(f"{stem}-") and name != os.path.basename(path) and not current:
+            try:
+                os.remove(os.path.join(export_dir(), name))
+            except FileNotFoundError:
+                pass
+    return path
+
+# -------------------- BULK IMPORT --------------------
+CSV_REQUIRED_COLUMNS = ['date', 'distance', 'transport_mode', 'electricity', 'lpg']
+CSV_CHUNK_ROWS = 50_000
+FAILED_ROWS_SHOWN = 100
+
+def import_row_keys(source_id: str, user_id, positions) -> List[str]:
+    """Idempotency keys for rows of one upload, stable across reruns of the import."""
+    return [hashlib.sha256(f"csv:{user_id}:{source_id}:{pos}".encode()).hexdigest()[:32] for pos in positions]
+
+def prepare_import_frame(df_csv: pd.DataFrame, user_id, alias, source_id: Optional[str] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Validate a CSV frame and compute its emissions as column arithmetic.
+
+    Returns (records, failed): records holds EMISSION_COLUMNS for every valid row,
+    failed holds the offending input rows with a 'reason' column. With a source_id,
+    each record's idempotency_key is derived from it and the row's index.
+    """
+    dates = pd.to_datetime(df_csv['date'], errors='coerce', format='mixed')
+    distance = pd.to_numeric(df_csv['distance'], errors='coerce').astype(float)
+    electricity = pd.to_numeric(df_csv['electricity'], errors='coerce').astype(float)
+    lpg = pd.to_numeric(df_csv['lpg'], errors='coerce').astype(float)
+
+    # First failing check wins, so apply them in reverse order of precedence
+    reason = pd.Series('', index=df_csv.index)
+    reason = reason.mask(lpg.isna(), 'invalid lpg')
+    reason = reason.mask(electricity.isna(), 'invalid electricity')
+    reason = reason.mask(distance.isna(), 'invalid distance')
+    reason = reason.mask(dates.isna(), 'invalid date')
+    ok = reason == ''
+
+    records = pd.DataFrame({
+        'user_id': user_id,
+        'alias': df_csv['alias'] if 'alias' in df_csv.columns else alias,
+        'date': dates.dt.strftime('%Y-%m-%d'),
+        'transport_mode': df_csv['transport_mode'],
+        'distance': distance,
+        'electricity': electricity,
+        'lpg': lpg,
+        'notes': df_csv['notes'] if 'notes' in df_csv.columns else '',
+    }, index=df_csv.index)[ok]
+    records = records.assign(**compute_emissions_array(
+        records['distance'], records['transport_mode'], records['electricity'], records['lpg']
+    ))
+
+    if source_id is not None:
+        records['idempotency_key'] = import_row_keys(source_id, user_id, records.index)
+
+    failed = df_csv[~ok].assign(reason=reason[~ok])
+    return records.reindex(columns=EMISSION_COLUMNS), failed
+
+def import_csv_stream(uploaded, user_id, alias, progress=None) -> Tuple[int, int, pd.DataFrame]:
+    """Validate, compute and insert a CSV upload one chunk at a time.
+
+    Only one chunk is materialized at a time, and at most FAILED_ROWS_SHOWN failed
+    rows are kept for display. progress, if given, is called with the fraction of the
+    file consumed after each chunk. Row keys come from the upload's file_id and the
+    row number, so rerunning an interrupted import skips the rows already stored.
+    Returns (imported, failed, sample of failed rows); raises ValueError when required
+    columns are missing.
+    """
+    total_bytes = getattr(uploaded, 'size', 0)
+    source_id = getattr(uploaded, 'file_id', None)
+    imported = failed_count = 0
+    failed_sample = []
+    for chunk in pd.read_csv(uploaded, chunksize=CSV_CHUNK_ROWS):
+        missing = [c for c in CSV_REQUIRED_COLUMNS if c not in chunk.columns]
+        if missing:
+            raise ValueError(f"Missing required columns: {missing}")
+        records, failed = prepare_import_frame(chunk, user_id, alias, source_id)
+        if len(records):
+            imported += insert_local_bulk(records)
+        failed_count += len(failed)
+        room = FAILED_ROWS_SHOWN - sum(len(f) for f in failed_sample)
+        if room > 0 and not failed.empty:
+            failed_sample.append(failed.head(room))
+        if progress and total_bytes:
+            progress(min(uploaded.tell() / total_bytes, 1.0))
+    return imported, failed_count, pd.concat(failed_sample) if failed_sample else pd.DataFrame()
 
 # -------------------- AUTH --------------------
 def supabase_sign_in_ui():
@@ -143,6 +1682,12 @@ def supabase_sign_in_ui():
     if not supabase:
         st.sidebar.info("Supabase not configured: local-only mode.")
         return None
+    pending = outbox_pending_count()
+    if pending:
+        st.sidebar.caption(f"⏳ {pending} record(s) waiting to sync to Supabase")
+    failed = outbox_failed_count()
+    if failed:
+        st.sidebar.caption(f"⚠️ {failed} record(s) rejected by Supabase and no longer retried")
     if 'user' not in st.session_state:
         st.session_state['user'] = None
         st.session_state['user_id'] = None
@@ -150,7 +1695,11 @@ def supabase_sign_in_ui():
         email = st.sidebar.text_input("Email for sign in (magic link)")
         if st.sidebar.button("Send Magic Link") and email:
             try:
-                supabase.auth.sign_in_with_email(email=email)
+                rest = supabase_rest()
+                if rest:
+                    rest.io.run(rest.send_magic_link(email))
+                else:
+                    supabase.auth.sign_in_with_email(email=email)
                 st.sidebar.success("Check your email for magic link. Refresh page after signing in.")
             except Exception as e:
                 st.sidebar.error(f"Auth error: {e}")
@@ -201,162 +1750,593 @@ def page_enter_data():
             'total_emission': em['total_emission'],
             'notes': notes
         }
-        if not insert_supabase(record):
-            insert_local(record)
+        insert_local(record)
         st.success(f"Saved — {em['total_emission']:.2f} kg CO₂")
 
     # CSV Upload
     st.markdown("---")
     st.markdown("### Import CSV (columns: date, distance, transport_mode, electricity, lpg, alias(optional), notes(optional))")
     uploaded = st.file_uploader("Upload CSV", type=["csv"])
-    if uploaded:
-        df_csv = pd.read_csv(uploaded)
-        required = ['date','distance','transport_mode','electricity','lpg']
-        missing = [c for c in required if c not in df_csv.columns]
-        if missing:
-            st.error(f"Missing required columns: {missing}")
+    # the uploader keeps its file across reruns; import each upload only once
+    if uploaded and st.session_state.get('_imported_upload') == uploaded.file_id:
+        st.info("This file has already been imported.")
+    elif uploaded:
+        bar = st.progress(0.0, text="Importing…")
+        try:
+            count, failed_count, failed = import_csv_stream(
+                uploaded, user_id, alias, progress=lambda done: bar.progress(done, text=f"Importing… {done:.0%}")
+            )
+        except ValueError as e:
+            bar.empty()
+            st.error(str(e))
         else:
-            count = 0
-            for _, row in df_csv.iterrows():
-                try:
-                    date_str = pd.to_datetime(row['date']).date().isoformat()
-                    em = compute_emissions(row['distance'], row['transport_mode'], row['electricity'], row['lpg'])
-                    rec = {
-                        'user_id': user_id,
-                        'alias': row.get('alias', alias),
-                        'date': date_str,
-                        'transport_mode': row['transport_mode'],
-                        'distance': float(row['distance']),
-                        'electricity': float(row['electricity']),
-                        'lpg': float(row['lpg']),
-                        'transport_emission': em['transport_emission'],
-                        'electricity_emission': em['electricity_emission'],
-                        'lpg_emission': em['lpg_emission'],
-                        'total_emission': em['total_emission'],
-                        'notes': row.get('notes','')
-                    }
-                    if not insert_supabase(rec):
-                        insert_local(rec)
-                    count += 1
-                except Exception as e:
-                    st.warning(f"Failed row: {e}")
+            bar.empty()
+            st.session_state['_imported_upload'] = uploaded.file_id
+            if failed_count:
+                st.warning(f"Failed {failed_count} rows" + (f" (first {len(failed)} shown)" if failed_count > len(failed) else ""))
+                st.dataframe(failed)
             st.success(f"Imported {count} rows")
 
-# -------------------- HISTORY --------------------
-def page_history():
-    st.header("History & Charts")
-    user_id = st.session_state.get('user_id')
-    df = fetch_all_local_for_user(user_id)
-    if df.empty:
-        st.info("No data yet")
-        return
-
-    st.dataframe(df[['date','alias','distance','electricity','lpg','total_emission']].sort_values('date',ascending=False))
+# -------------------- CHARTS --------------------
+# Rendered PNGs are cached per (user, data version, chart, size), so a history is
+# drawn once per change no matter how many sessions view it. Figures are built with
+# matplotlib.figure.Figure, which pyplot's global registry never sees.
+CHART_CACHE_ENTRIES = 256
+CHART_DPI = 100
+CHART_MAX_POINTS = 240
 
-    df['date'] = pd.to_datetime(df['date'])
+def lttb_indices(x, y, threshold: int):
+    """Indices of the points Largest-Triangle-Three-Buckets keeps to draw y over x.
 
-    # Only sum numeric columns
-    numeric_cols = ['distance','electricity','lpg','transport_emission','electricity_emission','lpg_emission','total_emission']
-    df_monthly = df.groupby(df['date'].dt.to_period("M"))[numeric_cols].sum().reset_index()
-    df_monthly['date'] = df_monthly['date'].dt.to_timestamp()
+    The first and last points are always kept; every bucket in between contributes
+    the point forming the largest triangle with the previously kept point and the
+    average of the next bucket.
+    """
+    n = len(y)
+    if threshold < 3 or n <= threshold:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    keep, a = [0], 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nxt_hi = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[hi:nxt_hi].mean(), y[hi:nxt_hi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(area.argmax())
+        keep.append(a)
+    keep.append(n - 1)
+    return np.array(keep)
 
-    fig, ax = plt.subplots(figsize=(8,4))
+def _monthly_total_chart(user_id, size):
+    df_monthly = fetch_user_rollup('monthly', user_id)
+    df_monthly = df_monthly.assign(date=pd.to_datetime(df_monthly['month']))
+    df_monthly = df_monthly.iloc[lttb_indices(df_monthly['date'].astype('int64'), df_monthly['total_emission'], CHART_MAX_POINTS)]
+    fig = mpl_figure.Figure(figsize=size)
+    ax = fig.subplots()
     ax.plot(df_monthly['date'], df_monthly['total_emission'], marker="o")
     ax.set_title("Monthly Total CO₂ Emissions")
     ax.set_xlabel("Month")
     ax.set_ylabel("kg CO₂")
-    plt.xticks(rotation=45)
-    st.pyplot(fig)
+    ax.tick_params(axis='x', labelrotation=45)
+    return fig
 
+def _recent_breakdown_chart(user_id, size):
     # Last 14 days stacked bar
-    last = df.sort_values('date').tail(14)
-    fig2, ax2 = plt.subplots(figsize=(10,4))
-    ax2.bar(last['date'], last['transport_emission'], label='Transport')
-    ax2.bar(last['date'], last['electricity_emission'], bottom=last['transport_emission'], label='Electricity')
+    last = fetch_user_rollup('daily', user_id).tail(14)
+    last = last.assign(date=pd.to_datetime(last['day']))
+    fig = mpl_figure.Figure(figsize=size)
+    ax = fig.subplots()
+    ax.bar(last['date'], last['transport_emission'], label='Transport')
+    ax.bar(last['date'], last['electricity_emission'], bottom=last['transport_emission'], label='Electricity')
     bottoms = last['transport_emission'] + last['electricity_emission']
-    ax2.bar(last['date'], last['lpg_emission'], bottom=bottoms, label='LPG')
-    ax2.legend()
-    plt.xticks(rotation=45)
-    st.pyplot(fig2)
+    ax.bar(last['date'], last['lpg_emission'], bottom=bottoms, label='LPG')
+    ax.legend()
+    ax.tick_params(axis='x', labelrotation=45)
+    return fig
+
+CHARTS = {
+    'monthly_total': _monthly_total_chart,
+    'recent_breakdown': _recent_breakdown_chart,
+}
+
+class ChartCache:
+    """Process-wide LRU of rendered chart bytes."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._images: OrderedDict = OrderedDict()
+
+    def get(self, key) -> Optional[bytes]:
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+            return image
+
+    def put(self, key, image: bytes):
+        with self._lock:
+            self._images[key] = image
+            self._images.move_to_end(key)
+            while len(self._images) > self.max_entries:
+                self._images.popitem(last=False)
 
-    # CSV download
-    csv = df.to_csv(index=False).encode("utf-8")
-    st.download_button("📥 Download History CSV", data=csv, file_name="co2_history.csv", mime="text/csv")
+@st.cache_resource
+def chart_cache() -> ChartCache:
+    return ChartCache(CHART_CACHE_ENTRIES)
+
+def render_chart(kind: str, user_id, size: Tuple[int, int]) -> bytes:
+    """PNG bytes of a history chart, drawn only when the user's data version changed."""
+    user_key = user_id or ALL_USERS_KEY
+    key = (user_key, history_versions().version(user_key), kind, size)
+    png = chart_cache().get(key)
+    if png is None:
+        fig = CHARTS[kind](user_id, size)
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png', dpi=CHART_DPI, bbox_inches='tight')
+        fig.clear()
+        png = buf.getvalue()
+        chart_cache().put(key, png)
+    return png
+
+# -------------------- HISTORY --------------------
+def history_table(user_id):
+    """One page of the history table with newer/older navigation."""
+    cursors = st.session_state.setdefault(f"history_cursors:{user_id or ALL_USERS_KEY}", [FIRST_PAGE_CURSOR])
+    page = fetch_history_page(user_id, cursors[-1])
+    st.dataframe(page.drop(columns='id'), hide_index=True)
+    newer, position, older = st.columns([1, 2, 1])
+    if newer.button("◀ Newer", disabled=len(cursors) == 1):
+        cursors.pop()
+        st.rerun()
+    position.caption(f"Page {len(cursors)}")
+    if older.button("Older ▶", disabled=len(page) < HISTORY_PAGE_ROWS):
+        cursors.append((page['date'].iloc[-1], int(page['id'].iloc[-1])))
+        st.rerun()
+
+def page_history():
+    st.header("History & Charts")
+    user_id = st.session_state.get('user_id')
+    if not emission_totals(user_id)[1]:
+        st.info("No data yet")
+        return
+
+    history_table(user_id)
+
+    st.image(render_chart('monthly_total', user_id, (8, 4)))
+    st.image(render_chart('recent_breakdown', user_id, (10, 4)))
+
+    # Download, generated only when asked for and served from disk
+    formats = available_export_formats()
+    fmt = st.selectbox("Export format", formats)
+    ext, mime, _ = EXPORT_FORMATS[fmt]
+    version = history_versions().version(user_id or ALL_USERS_KEY)
+    key = (user_id, fmt, version)
+    prepared = st.session_state.get('_export')
+    if not (prepared and prepared[0] == key and os.path.exists(prepared[1])):
+        prepared = None
+        if st.button(f"Prepare {fmt} export"):
+            with st.spinner("Writing export…"):
+                prepared = (key, export_history(user_id, fmt, version))
+            st.session_state['_export'] = prepared
+    if prepared:
+        url = export_url(prepared[1])
+        if url:
+            st.markdown(f'<a href="{url}" download="co2_history.{ext}">📥 Download History {fmt}</a>',
+                        unsafe_allow_html=True)
+        else:
+            st.download_button(f"📥 Download History {fmt}", data=lambda: open(prepared[1], 'rb'),
+                               file_name=f"co2_history.{ext}", mime=mime)
 
   
 # -------------------- GOALS & ALERTS --------------------
+def _save_goal_job(conn: sqlite3.Connection, user_id, target: float):
+    conn.execute("""
+        INSERT INTO user_goals (user_id, weekly_target, updated_at, origin)
+        VALUES (?, ?, ?, (SELECT value FROM sync_meta WHERE key = 'origin'))
+        ON CONFLICT (user_id) DO UPDATE SET weekly_target = excluded.weekly_target,
+            updated_at = excluded.updated_at, origin = excluded.origin
+    """, (user_id, target, time.time()))
+
 def page_goals_and_alerts():
     st.header("Goals & Alerts")
     user_id = st.session_state.get('user_id')
     c = sqlite_conn.cursor()
     current = None
     if user_id:
-        c.execute("SELECT weekly_target FROM user_goals WHERE user_id=?", (user_id,))
+        c.execute(USER_GOAL_SQL, (user_id,))
         r = c.fetchone()
         if r: current = r[0]
     target = st.number_input("Weekly emissions target (kg CO2)", min_value=0.0, value=current or 20.0)
     if st.button("Save target"):
-        if current is None:
-            c.execute("INSERT INTO user_goals (user_id, weekly_target) VALUES (?,?)", (user_id, float(target)))
-        else:
-            c.execute("UPDATE user_goals SET weekly_target=? WHERE user_id=?", (float(target), user_id))
-        sqlite_conn.commit()
+        db_write(_save_goal_job, user_id, float(target))
+        wake_sync_engine()
         st.success("Saved goal")
 
     # Weekly check
     today = datetime.date.today()
     start_week = today - datetime.timedelta(days=today.weekday())
-    df = fetch_all_local_for_user(user_id)
-    if not df.empty:
-        df['date'] = pd.to_datetime(df['date']).dt.date
-        week_df = df[(df['date'] >= start_week) & (df['date'] <= today)]
-        weekly_total = week_df['total_emission'].sum()
-        st.metric("This week's total (kg CO2)", f"{weekly_total:.2f}")
-        if weekly_total > target:
-            st.error("⚠️ You have exceeded your weekly target.")
-        else:
-            st.success("👍 Within weekly target.")
+    week_total = weekly_total(user_id, start_week, today)
+    st.metric("This week's total (kg CO2)", f"{week_total:.2f}")
+    if week_total > target:
+        st.error("⚠️ You have exceeded your weekly target.")
+    else:
+        st.success("👍 Within weekly target.")
 
 # -------------------- LEADERBOARD --------------------
 def page_leaderboard():
     st.header("Public Leaderboard")
-    df_all = fetch_all_local_for_user(None)
-    if df_all.empty:
+    top = leaderboard_table()
+    if top.empty:
         st.info("No data yet")
         return
-    today = datetime.date.today()
-    start_week = today - datetime.timedelta(days=7)
-    df_all['date'] = pd.to_datetime(df_all['date']).dt.date
-    week = df_all[df_all['date'] >= start_week]
-    agg = week.groupby('alias').agg({'total_emission':'sum'}).reset_index()
-    agg['alias'] = agg['alias'].fillna('Anonymous')
-    agg = agg.sort_values('total_emission')
-    st.table(agg.head(10).rename(columns={'total_emission':'weekly_total_kgCO2'}))
+    st.table(top)
     st.markdown("**Leaderboard:** Top performers have lowest weekly CO₂ totals.")
 
+# -------------------- AI TIPS CACHE --------------------
+# Tips are stored in SQLite keyed on the model and a hash of the normalized prompt, so
+# repeat views skip the API call until the TTL runs out. With AI_TIPS_SIMILARITY_KG set,
+# numbers in the prompt are rounded to that step first, so summaries that differ only
+# slightly share their tips. Identical requests in flight share one API call.
+AI_TIPS_TTL_SECONDS = float(st.secrets.get("AI_TIPS_TTL_HOURS", 24)) * 3600
+AI_TIPS_SIMILARITY_KG = float(st.secrets.get("AI_TIPS_SIMILARITY_KG", 0))
+AI_TIPS_TIMEOUT_SECONDS = float(st.secrets.get("AI_TIPS_TIMEOUT_SECONDS", 30))
+NUMBER_RE = re.compile(r"\d+\.\d+")
+SELECT_TIPS_SQL = "SELECT tips FROM ai_tips_cache WHERE cache_key = ? AND created_at > ?"
+
+class SingleFlight:
+    """Runs at most one call per key at a time; concurrent callers share its result."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Any, Future] = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._calls.get(key)
+            owner = future is None
+            if owner:
+                future = self._calls[key] = Future()
+        if owner:
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                # a script stopped by a rerun raises a BaseException; waiters get a plain error
+                future.set_exception(e if isinstance(e, Exception) else RuntimeError("Request was cancelled"))
+                if not isinstance(e, Exception):
+                    raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+        return future.result()
+
+@st.cache_resource
+def tips_calls() -> SingleFlight:
+    return SingleFlight()
+
+def tips_cache_key(model: str, prompt: str, similarity: float = AI_TIPS_SIMILARITY_KG) -> str:
+    normalized = " ".join(prompt.split()).lower()
+    if similarity > 0:
+        normalized = NUMBER_RE.sub(lambda m: str(round(float(m.group()) / similarity)), normalized)
+    return hashlib.sha256(f"{model}\0{normalized}".encode()).hexdigest()
+
+def _save_tips_job(conn: sqlite3.Connection, key: str, model: str, tips: str, now: float):
+    conn.execute("INSERT OR REPLACE INTO ai_tips_cache (cache_key, model, tips, created_at) VALUES (?, ?, ?, ?)",
+                 (key, model, tips, now))
+    conn.execute("DELETE FROM ai_tips_cache WHERE created_at <= ?", (now - AI_TIPS_TTL_SECONDS,))
+
+def cached_tips(prompt: str, generate) -> Tuple[str, bool]:
+    """(tips, whether they came from the cache); generate(prompt) is called on a miss."""
+    key = tips_cache_key(OPENAI_MODEL, prompt)
+    row = sqlite_conn.execute(SELECT_TIPS_SQL, (key, time.time() - AI_TIPS_TTL_SECONDS)).fetchone()
+    if row:
+        return row[0], True
+
+    def call():
+        tips = generate(prompt)
+        db_write(_save_tips_job, key, OPENAI_MODEL, tips, time.time())
+        return tips
+    return tips_calls().do(key, call), False
+
+# -------------------- PROMPT BUILDER --------------------
+# The tips prompt is held to a fixed token budget. A short statistical summary of the
+# whole history always goes in; recent daily totals and then weekly totals, newest
+# first, are added for as long as they fit. Tokens are counted with tiktoken, or
+# estimated at four characters per token when its encodings are unavailable.
+AI_PROMPT_TOKEN_BUDGET = int(st.secrets.get("AI_PROMPT_TOKEN_BUDGET", 600))
+TIPS_PROMPT_HEAD = "You are a sustainability assistant. Here is a summary of a user's CO₂ emissions (kg CO₂)."
+TIPS_PROMPT_TAIL = "Provide 10 actionable tips for reducing emissions."
+TREND_WEEKS = 4
+
+@st.cache_resource
+def token_encoder():
+    """The tiktoken encoding for OPENAI_MODEL, or None to fall back to an estimate."""
+    if importlib.util.find_spec("tiktoken") is None:
+        return None
+    tiktoken = timed_import("tiktoken")
+    try:
+        try:
+            return tiktoken.encoding_for_model(OPENAI_MODEL)
+        except KeyError:  # a model this tiktoken does not know yet
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:  # the encoding files are downloaded on first use
+        logger.warning("tiktoken unavailable, estimating token counts: %s", e)
+        return None
+
+def count_tokens(text: str) -> int:
+    encoder = token_encoder()
+    if encoder is None:
+        return (len(text) + 3) // 4
+    return len(encoder.encode(text))
+
+def history_summary(weekly: pd.DataFrame) -> List[str]:
+    """Weekly mean, per-category shares and recent trend of a weekly rollup frame."""
+    if weekly.empty:
+        return []
+    total = weekly['total_emission'].sum()
+    lines = [f"History: {int(weekly['entries'].sum())} entries over {len(weekly)} weeks, "
+             f"{total:.2f} kg in total, {weekly['total_emission'].mean():.2f} kg per week on average."]
+    if total > 0:
+        shares = {name: weekly[f'{name}_emission'].sum() / total for name in ('transport', 'electricity', 'lpg')}
+        lines.append("Share by source: " + ", ".join(f"{name} {share:.0%}" for name, share in shares.items()) + ".")
+    if len(weekly) >= 2 * TREND_WEEKS:
+        recent = weekly['total_emission'].iloc[-TREND_WEEKS:].mean()
+        before = weekly['total_emission'].iloc[-2 * TREND_WEEKS:-TREND_WEEKS].mean()
+        change = f" ({(recent - before) / before:+.0%})" if before else ""
+        lines.append(f"Trend: {recent:.2f} kg per week over the last {TREND_WEEKS} weeks, "
+                     f"{before:.2f} the {TREND_WEEKS} before{change}.")
+    return lines
+
+def build_tips_prompt(user_id, budget: int = AI_PROMPT_TOKEN_BUDGET) -> Tuple[str, int]:
+    """(prompt, its token count) for the tips request, within budget where possible."""
+    weekly = fetch_user_rollup('weekly', user_id)
+    sections = [
+        (None, history_summary(weekly)),
+        ("Recent daily totals:", [f"{day}: {total:.2f} kg" for day, total in recent_daily_totals(user_id, 7)]),
+        ("Weekly totals, newest first:", [
+            f"week of {week}: {total:.2f} kg"
+            for week, total in zip(weekly['week_start'][::-1], weekly['total_emission'][::-1])
+        ]),
+    ]
+    lines = [TIPS_PROMPT_HEAD]
+    used = count_tokens(TIPS_PROMPT_HEAD) + count_tokens(TIPS_PROMPT_TAIL) + 1
+    for title, rows in sections:
+        body, cost = [], count_tokens(title) + 1 if title else 0
+        for line in rows:
+            line_cost = count_tokens(line) + 1
+            if used + cost + line_cost > budget:
+                break
+            body.append(line)
+            cost += line_cost
+        if body:
+            lines.extend([title, *body] if title else body)
+            used += cost
+    lines.append(TIPS_PROMPT_TAIL)
+    prompt = "\n".join(lines)
+    tokens = count_tokens(prompt)
+    logger.info("Tips prompt: %d tokens (budget %d) from %d weeks of history", tokens, budget, len(weekly))
+    return prompt, tokens
+
+def stream_tips(prompt: str, timeout: float = AI_TIPS_TIMEOUT_SECONDS):
+    """Yield the tips text as it arrives; raises TimeoutError once the budget is spent.
+
+    Closing the generator (a rerun stopping the script) closes the HTTP stream.
+    """
+    deadline = time.monotonic() + timeout
+    stream = get_openai_client().responses.create(model=OPENAI_MODEL, input=prompt, max_output_tokens=300,
+                                                  stream=True, timeout=timeout)
+    try:
+        for event in stream:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"No complete answer within {timeout:g}s")
+            if event.type == 'response.output_text.delta':
+                yield event.delta
+            elif event.type == 'response.completed' and event.response.usage:
+                usage = event.response.usage
+                logger.info("Tips response: %d input tokens, %d output tokens", usage.input_tokens, usage.output_tokens)
+            elif event.type in ('response.failed', 'error'):
+                raise RuntimeError(getattr(event, 'message', None) or "The model returned an error")
+    finally:
+        stream.close()
+
+# -------------------- BATCH TIPS --------------------
+# Tips for everyone active in the last week, prepared offline so the insights page can
+# show them without waiting on the model:
+#
+#   python app.py batch-tips                       # call the API concurrently, rate limited
+#   python app.py batch-tips --write-batch-file f  # write an OpenAI Batch API input file
+#   python app.py batch-tips --import-results f    # store the output file of that batch
+AI_BATCH_CONCURRENCY = int(st.secrets.get("AI_BATCH_CONCURRENCY", 4))
+AI_BATCH_REQUESTS_PER_MINUTE = float(st.secrets.get("AI_BATCH_REQUESTS_PER_MINUTE", 60))
+AI_BATCH_ACTIVE_DAYS = 7
+SELECT_USER_TIPS_SQL = "SELECT tips, created_at FROM ai_tips WHERE user_key = ?"
+
+def active_users(days: int = AI_BATCH_ACTIVE_DAYS, today: Optional[datetime.date] = None) -> List[str]:
+    since = (today or datetime.date.today()) - datetime.timedelta(days=days - 1)
+    return [r[0] for r in sqlite_conn.execute(ACTIVE_USERS_SQL, (since.isoformat(),))]
+
+def _save_user_tips_job(conn: sqlite3.Connection, rows: List[tuple]):
+    conn.executemany("INSERT OR REPLACE INTO ai_tips (user_key, model, tips, created_at) VALUES (?, ?, ?, ?)", rows)
+
+def prepared_tips(user_id) -> Optional[Tuple[str, float]]:
+    """(tips, created_at) prepared for a user by the batch job, if any."""
+    if not user_id:
+        return None
+    return sqlite_conn.execute(SELECT_USER_TIPS_SQL, (user_id,)).fetchone()
+
+class AsyncRateLimiter:
+    """Spaces request starts evenly so that at most per_minute begin in any minute."""
+    def __init__(self, per_minute: float):
+        self.interval = 60.0 / per_minute
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            now = loop.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+async def _generate_tips_async(client, prompts: Dict[str, str], concurrency: int, per_minute: float,
+                               on_result=None) -> Dict[str, str]:
+    """Tips per user; users whose request fails are logged and left out.
+
+    on_result, if given, is called with (user_key, tips) as each request completes.
+    """
+    limiter = AsyncRateLimiter(per_minute)
+    slots = asyncio.Semaphore(concurrency)
+    results = {}
+
+    async def one(user_key, prompt):
+        async with slots:
+            await limiter.wait()
+            try:
+                response = await client.responses.create(model=OPENAI_MODEL, input=prompt, max_output_tokens=300,
+                                                         timeout=AI_TIPS_TIMEOUT_SECONDS)
+            except Exception as e:
+                logger.warning("Tips for %s failed: %s", user_key, e)
+                return
+        if response.usage:
+            logger.info("Tips for %s: %d input tokens, %d output tokens",
+                        user_key, response.usage.input_tokens, response.usage.output_tokens)
+        results[user_key] = response.output_text
+        if on_result:
+            on_result(user_key, response.output_text)
+
+    await asyncio.gather(*(one(k, p) for k, p in prompts.items()))
+    return results
+
+def batch_deadline(users: int) -> float:
+    """Seconds a batch may take: the slower of the rate limit and the concurrency, plus one request."""
+    paced = users * 60.0 / AI_BATCH_REQUESTS_PER_MINUTE
+    waves = -(-users // AI_BATCH_CONCURRENCY) * AI_TIPS_TIMEOUT_SECONDS
+    return max(paced, waves) + AI_TIPS_TIMEOUT_SECONDS
+
+def run_batch_tips(users: List[str]) -> int:
+    """Generate and store tips for users through the async client. Returns how many were stored.
+
+    Each user's tips are stored as soon as they arrive, so a batch that times out or
+    is interrupted keeps what it finished.
+    """
+    prompts = {u: build_tips_prompt(u)[0] for u in users}
+    writer = get_sqlite_writer()
+    saves: List[Future] = []
+
+    def save(user_key, tips):
+        saves.append(writer.submit(_save_user_tips_job, [(user_key, OPENAI_MODEL, tips, time.time())]))
+
+    deadline = batch_deadline(len(prompts))
+    io = async_io()
+    try:
+        if io:
+            # shares the pooled connections of the I/O layer; closing it would close the pool
+            client = timed_import("openai").AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=io.http)
+            io.run(_generate_tips_async(client, prompts, AI_BATCH_CONCURRENCY, AI_BATCH_REQUESTS_PER_MINUTE, save),
+                   timeout=deadline)
+        else:
+            async def run():
+                client = timed_import("openai").AsyncOpenAI(api_key=OPENAI_API_KEY)
+                try:
+                    return await asyncio.wait_for(_generate_tips_async(
+                        client, prompts, AI_BATCH_CONCURRENCY, AI_BATCH_REQUESTS_PER_MINUTE, save), deadline)
+                finally:
+                    await client.close()
+
+            asyncio.run(run())
+    except (TimeoutError, asyncio.TimeoutError, KeyboardInterrupt) as e:
+        reason = "interrupted" if isinstance(e, KeyboardInterrupt) else f"timed out after {deadline:.0f}s"
+        logger.warning("Batch tips %s with %d of %d users done", reason, len(saves), len(prompts))
+    for future in list(saves):
+        future.result()
+    return len(saves)
+
+def write_batch_file(users: List[str], path: str) -> int:
+    """Write one Batch API request per user to a JSONL file; custom_id is the user id."""
+    with open(path, 'w', encoding='utf-8') as f:
+        for user_key in users:
+            body = {'model': OPENAI_MODEL, 'input': build_tips_prompt(user_key)[0], 'max_output_tokens': 300}
+            f.write(json.dumps({'custom_id': user_key, 'method': 'POST', 'url': '/v1/responses', 'body': body}) + "\n")
+    return len(users)
+
+def import_batch_results(path: str) -> int:
+    """Store the tips from a Batch API output file. Returns how many were stored."""
+    rows, now = [], time.time()
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            result = json.loads(line)
+            response = result.get('response') or {}
+            if response.get('status_code') != 200:
+                logger.warning("Batch tips for %s failed: %s", result.get('custom_id'), result.get('error'))
+                continue
+            body = response['body']
+            text = "".join(part['text'] for item in body.get('output', []) if item.get('type') == 'message'
+                           for part in item.get('content', []) if part.get('type') == 'output_text')
+            rows.append((result['custom_id'], body.get('model', OPENAI_MODEL), text, now))
+    db_write(_save_user_tips_job, rows)
+    return len(rows)
+
+def batch_tips_cli(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="app.py batch-tips", description="Prepare AI tips for active users.")
+    parser.add_argument("--days", type=int, default=AI_BATCH_ACTIVE_DAYS, help="how recently users must have logged")
+    parser.add_argument("--write-batch-file", metavar="PATH", help="write Batch API requests instead of calling the API")
+    parser.add_argument("--import-results", metavar="PATH", help="store the tips from a Batch API output file")
+    args = parser.parse_args(argv)
+    if args.import_results:
+        print(f"Stored tips for {import_batch_results(args.import_results)} users")
+        return 0
+    users = active_users(args.days)
+    if args.write_batch_file:
+        print(f"Wrote {write_batch_file(users, args.write_batch_file)} requests to {args.write_batch_file}")
+        return 0
+    if not OPENAI_AVAILABLE:
+        print("OpenAI not configured.", file=sys.stderr)
+        return 1
+    stored = run_batch_tips(users)
+    print(f"Stored tips for {stored} of {len(users)} active users")
+    return 0 if stored == len(users) else 1
+
 # -------------------- INSIGHTS --------------------
 def page_insights():
     st.header("Insights & AI Recommendations")
     user_id = st.session_state.get('user_id')
-    df = fetch_all_local_for_user(user_id)
-    if df.empty:
+    total_saved, entries = emission_totals(user_id)
+    if not entries:
         st.info("Add entries first to see insights.")
         return
-    total_saved = df['total_emission'].sum()
-    avg_per_entry = df['total_emission'].mean()
+    avg_per_entry = total_saved / entries
     col1, col2 = st.columns(2)
     col1.metric("Total (saved entries) kg CO₂", f"{total_saved:.2f}")
     col2.metric("Average per entry (kg CO₂)", f"{avg_per_entry:.2f}")
 
     # GPT Tips
+    prepared = prepared_tips(user_id)
+    if prepared:
+        st.markdown(prepared[0])
+        st.caption(f"Prepared {datetime.datetime.fromtimestamp(prepared[1]):%Y-%m-%d %H:%M}")
     if OPENAI_AVAILABLE:
         if st.button("Get GPT Tips"):
-            last = df.tail(7)
-            summary = "\n".join([f"{r['date']}: {r['total_emission']:.2f} kg" for _,r in last.iterrows()])
-            prompt = f"You are a sustainability assistant. Given recent daily CO₂ totals:\n{summary}\nProvide 10 actionable tips for reducing emissions."
+            streamed = []
+
+            def generate(prompt):
+                stop = st.empty()
+                stop.button("Stop")  # any click reruns the page, which cancels the stream
+                streamed.append(True)
+                try:
+                    return st.write_stream(stream_tips(prompt))
+                finally:
+                    stop.empty()
+
             try:
-                response = client.responses.create(model=OPENAI_MODEL, input=prompt, max_output_tokens=300)
-                st.markdown(response.output_text)
+                prompt, _ = build_tips_prompt(user_id)
+                tips, cached = cached_tips(prompt, generate)
+                if not streamed:
+                    st.markdown(tips)
+                if cached:
+                    st.caption("Saved tips for this summary.")
             except Exception as e:
                 st.error(f"AI Error: {e}")
     else:
@@ -366,6 +2346,7 @@ def page_insights():
 def main():
     st.sidebar.title("Navigation")
     supabase_sign_in_ui()
+    refresh_user_mirror(st.session_state.get('user_id'))
     pages = {
         "Home": page_home,
         "Enter Data": page_enter_data,
@@ -378,4 +2359,6 @@ def main():
     pages[choice]()
 
 if __name__ == "__main__":
+    if not st.runtime.exists() and sys.argv[1:2] == ["batch-tips"]:
+        sys.exit(batch_tips_cli(sys.argv[2:]))
     main()
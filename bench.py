@@ -0,0 +1,166 @@
+"""Benchmarks for the Carbon Footprint Calculator.
+
+  python bench.py imports                          # cold import cost per module
+  python bench.py imports --save baseline.json     # record a baseline
+  python bench.py imports --baseline baseline.json # exit 1 on regressions
+  python bench.py compute                          # scalar vs array compute_emissions
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules app.py depends on, heaviest first; the last group must stay lazy.
+HEAVY_MODULES = ["streamlit", "pandas", "numpy", "matplotlib.figure", "openai", "supabase", "tiktoken"]
+LAZY_MODULES = ["pandas", "matplotlib.figure", "openai", "supabase", "tiktoken", "httpx"]
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+
+APP_SNIPPET = """
+import sys, time, json, logging
+logging.disable(logging.WARNING)
+sys.path.insert(0, {app_dir!r})
+import streamlit
+t = time.perf_counter()
+import app
+print(json.dumps({{"seconds": time.perf_counter() - t, "loaded": [m for m in {lazy!r} if m in sys.modules]}}))
+"""
+
+def _run(code, cwd=None):
+    out = subprocess.run([sys.executable, "-c", code], cwd=cwd, capture_output=True, text=True, check=True)
+    return out.stdout.strip().splitlines()[-1]
+
+def bench_module_imports(repeat):
+    """Median cold import time of each dependency, each in a fresh interpreter."""
+    results = {}
+    for module in HEAVY_MODULES:
+        try:
+            samples = [float(_run(IMPORT_SNIPPET.format(module=module))) for _ in range(repeat)]
+        except subprocess.CalledProcessError:
+            continue  # not installed here
+        results[module] = statistics.median(samples)
+    return results
+
+def bench_app_startup(repeat):
+    """Median time to execute app.py up to the first page (streamlit already imported)."""
+    samples, loaded = [], []
+    with tempfile.TemporaryDirectory() as tmp:
+        _write_secrets(tmp)
+        for _ in range(repeat):
+            result = json.loads(_run(APP_SNIPPET.format(app_dir=APP_DIR, lazy=LAZY_MODULES), cwd=tmp))
+            samples.append(result["seconds"])
+            loaded = result["loaded"]
+    return statistics.median(samples), loaded
+
+def _write_secrets(directory):
+    os.makedirs(os.path.join(directory, ".streamlit"))
+    with open(os.path.join(directory, ".streamlit", "secrets.toml"), "w") as f:
+        f.write('OPENAI_MODEL = "gpt-4o-mini"\n')
+
+def _load_app(directory):
+    """Import app.py in bare mode with its working files in directory."""
+    import logging
+    logging.disable(logging.WARNING)
+    _write_secrets(directory)
+    os.chdir(directory)
+    sys.path.insert(0, APP_DIR)
+    import app
+    return app
+
+def bench_compute(app, sizes, max_scalar_rows, seed=0):
+    """Seconds per call of the scalar loop and the array API at each size.
+
+    Above max_scalar_rows the scalar time is extrapolated from the largest measured size.
+    """
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    modes = np.array(app.TRANSPORT_MODES + ["Unknown"], dtype=object)
+    results, per_row = [], None
+    app.compute_emissions_array([1.0], modes[:1], [1.0], [1.0])  # warm up lazy imports
+    for n in sizes:
+        distance, electricity, lpg = rng.uniform(0, 50, n), rng.uniform(0, 20, n), rng.uniform(0, 2, n)
+        mode = modes[rng.integers(0, len(modes), n)]
+        t = time.perf_counter()
+        app.compute_emissions_array(distance, mode, electricity, lpg)
+        array_s = time.perf_counter() - t
+        if n <= max_scalar_rows:
+            t = time.perf_counter()
+            for row in zip(distance.tolist(), mode.tolist(), electricity.tolist(), lpg.tolist()):
+                app.compute_emissions(*row)
+            scalar_s, estimated = time.perf_counter() - t, False
+            per_row = scalar_s / n
+        else:
+            scalar_s, estimated = per_row * n, True
+        results.append((n, scalar_s, array_s, estimated))
+    return results
+
+def bench_single_call(app, repeat=10_000):
+    """Seconds per call for one row: the scalar path against a one-row array call."""
+    import timeit
+    args = (12.5, app.TRANSPORT_MODES[0], 3.0, 0.5)
+    scalar_s = min(timeit.repeat(lambda: app.compute_emissions(*args), number=repeat, repeat=5)) / repeat
+    array_s = min(timeit.repeat(lambda: app.compute_emissions_array(*([a] for a in args)),
+                                number=repeat // 100, repeat=5)) / (repeat // 100)
+    return scalar_s, array_s
+
+def cmd_compute(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        app = _load_app(tmp)
+        single = bench_single_call(app)
+        results = bench_compute(app, [int(10 ** e) for e in range(3, args.max_exp + 1)], args.max_scalar_rows)
+    print(f"one row: scalar {single[0] * 1e6:.1f} µs, array {single[1] * 1e6:.1f} µs")
+    print(f"{'rows':>10} {'scalar':>12} {'array':>12} {'speedup':>9}")
+    for n, scalar_s, array_s, estimated in results:
+        mark = "*" if estimated else " "
+        print(f"{n:>10} {scalar_s:11.4f}s{mark} {array_s:11.4f}s {scalar_s / array_s:8.0f}x")
+    if any(r[3] for r in results):
+        print("* extrapolated from the largest scalar run")
+    return 0
+
+def cmd_imports(args):
+    results = bench_module_imports(args.repeat)
+    results["app"], eagerly_loaded = bench_app_startup(args.repeat)
+    for name, seconds in results.items():
+        print(f"{name:<20} {seconds * 1000:9.1f} ms")
+    failed = False
+    if eagerly_loaded:
+        print(f"FAIL: app.py imported {eagerly_loaded} at startup")
+        failed = True
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for name, seconds in results.items():
+            before = baseline.get(name)
+            if before and seconds > before * (1 + args.tolerance):
+                print(f"FAIL: {name} regressed {before * 1000:.1f} ms -> {seconds * 1000:.1f} ms")
+                failed = True
+    return 1 if failed else 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    imports = sub.add_parser("imports", help="cold import cost per module and app startup")
+    imports.add_argument("--repeat", type=int, default=5)
+    imports.add_argument("--save", help="write results to this JSON file")
+    imports.add_argument("--baseline", help="compare against a JSON file written by --save")
+    imports.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown vs the baseline")
+    imports.set_defaults(func=cmd_imports)
+    compute = sub.add_parser("compute", help="scalar vs array compute_emissions at 1e3..1e7 rows")
+    compute.add_argument("--max-exp", type=int, default=7, help="largest size as a power of ten")
+    compute.add_argument("--max-scalar-rows", type=int, default=100_000)
+    compute.set_defaults(func=cmd_compute)
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+-- Remote table the outbox pushes to (see SUPABASE OUTBOX in app.py).
+-- Rows are upserted with on_conflict=idempotency_key, which needs the unique index;
+-- the mirror pages rows by id.
+create table if not exists daily_emissions (
+    id bigint generated by default as identity primary key,
+    user_id text,
+    alias text,
+    date text,
+    transport_mode text,
+    distance double precision,
+    electricity double precision,
+    lpg double precision,
+    transport_emission double precision,
+    electricity_emission double precision,
+    lpg_emission double precision,
+    total_emission double precision,
+    notes text
+);
+
+alter table daily_emissions add column if not exists idempotency_key text;
+create unique index if not exists daily_emissions_idempotency_key_key on daily_emissions (idempotency_key);
+create index if not exists daily_emissions_user_id_id_idx on daily_emissions (user_id, id);
@@ -0,0 +1,42 @@
+-- Remote settings tables for the sync engine (see SYNC ENGINE in app.py).
+-- One row per user; updated_at is epoch seconds as double precision, as in SQLite, and
+-- origin breaks ties. change_seq is set from one sequence on every insert and update,
+-- so a client can pull the changes above the last number it has seen.
+create sequence if not exists settings_change_seq;
+
+create or replace function set_change_seq() returns trigger as $$
+begin
+    new.change_seq := nextval('settings_change_seq');
+    return new;
+end;
+$$ language plpgsql;
+
+create table if not exists user_goals (
+    id bigint generated by default as identity primary key,
+    user_id text,
+    weekly_target double precision
+);
+
+create table if not exists leaderboard_aliases (
+    id bigint generated by default as identity primary key,
+    user_id text,
+    alias text
+);
+
+do $$
+declare
+    t text;
+begin
+    foreach t in array array['user_goals', 'leaderboard_aliases'] loop
+        execute format('alter table %I add column if not exists updated_at double precision not null default 0', t);
+        execute format('alter table %I add column if not exists origin text not null default ''''', t);
+        execute format('alter table %I add column if not exists change_seq bigint', t);
+        execute format('create unique index if not exists %I on %I (user_id)', t || '_user_id_key', t);
+        execute format('create index if not exists %I on %I (change_seq)', t || '_change_seq_idx', t);
+        execute format('drop trigger if exists %I on %I', t || '_change_seq', t);
+        execute format('create trigger %I before insert or update on %I for each row execute function set_change_seq()',
+                       t || '_change_seq', t);
+        execute format('update %I set change_seq = null where change_seq is null', t);  -- numbers existing rows
+    end loop;
+end;
+$$;
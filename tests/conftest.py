@@ -0,0 +1,34 @@
+import importlib
+import logging
+import os
+import pathlib
+import sys
+
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    """Import app.py against a fresh database in a scratch directory."""
+    workdir = tmp_path_factory.mktemp("app")
+    (workdir / ".streamlit").mkdir()
+    (workdir / ".streamlit" / "secrets.toml").write_text('OPENAI_MODEL = "gpt-4o-mini"\n')
+    cwd = os.getcwd()
+    disabled = logging.root.manager.disable
+    # background threads keep logging after pytest closes its capture streams
+    logging.disable(logging.WARNING)
+    os.chdir(workdir)
+    sys.path.insert(0, str(ROOT))
+    try:
+        yield importlib.import_module("app")
+    finally:
+        sys.path.remove(str(ROOT))
+        os.chdir(cwd)
+        # handlers created during the import hold pytest's capture stream, which closes next
+        for logger in [logging.root, *logging.root.manager.loggerDict.values()]:
+            for handler in getattr(logger, "handlers", []):
+                if isinstance(handler, logging.StreamHandler) and handler.stream is sys.stderr:
+                    handler.setStream(sys.__stderr__)
+        logging.disable(disabled)
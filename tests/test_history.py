@@ -0,0 +1,47 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+
+def test_history_pages_merge_the_hot_table_and_the_archive(app):
+    if not app.ARCHIVE_AVAILABLE:
+        pytest.skip("pyarrow is not installed")
+    user = 'history-user'
+
+    def insert(conn, *dates):
+        for date in dates:
+            conn.execute("INSERT INTO daily_emissions (user_id, date, total_emission) VALUES (?, ?, 1)", (user, date))
+
+    app.db_write(insert, '2020-01-05', '2020-03-05')
+    conn = sqlite3.connect(f"file:{app.DB_PATH}?mode=ro", uri=True)
+    try:
+        app.archive_cold_history(conn, app.get_sqlite_writer())
+    finally:
+        conn.close()
+    # mirrored later, so its id is higher than the archived rows while its date falls between them
+    app.db_write(insert, '2020-02-05', '2099-01-01')
+
+    dates, cursor = [], app.FIRST_PAGE_CURSOR
+    while True:
+        page = app.fetch_history_page(user, cursor, limit=2)
+        if page.empty:
+            break
+        dates += list(page['date'])
+        cursor = (page['date'].iloc[-1], int(page['id'].iloc[-1]))
+    assert dates == ['2099-01-01', '2020-03-05', '2020-02-05', '2020-01-05']
+
+
+def test_lttb_keeps_the_ends_and_the_peaks(app):
+    x = np.arange(100)
+    y = np.zeros(100)
+    y[37], y[71] = 10.0, -10.0
+    keep = app.lttb_indices(x, y, 10)
+    assert len(keep) == 10
+    assert keep[0] == 0 and keep[-1] == 99
+    assert list(keep) == sorted(keep)
+    assert {37, 71} <= set(keep)
+
+
+def test_lttb_returns_every_point_below_the_threshold(app):
+    assert list(app.lttb_indices([1, 2, 3], [3, 1, 2], 10)) == [0, 1, 2]
@@ -0,0 +1,47 @@
+import io
+
+
+class Upload(io.BytesIO):
+    """Stands in for Streamlit's UploadedFile."""
+    def __init__(self, data: bytes, file_id: str):
+        super().__init__(data)
+        self.file_id = file_id
+        self.size = len(data)
+
+
+CSV = (
+    "date,distance,transport_mode,electricity,lpg\n"
+    "2024-06-01,10,Motorbike,1,0\n"
+    "2024-06-02,5,Motorbike,2,0.5\n"
+    "not a date,5,Motorbike,2,0.5\n"
+    "2024-06-03,7,Motorbike,0,0\n"
+).encode()
+
+
+def count_rows(app, user):
+    return app.sqlite_conn.execute("SELECT COUNT(*) FROM daily_emissions WHERE user_id = ?", (user,)).fetchone()[0]
+
+
+def test_reimporting_the_same_upload_skips_stored_rows(app):
+    user = 'import-user'
+    imported, failed, sample = app.import_csv_stream(Upload(CSV, 'upload-1'), user, None)
+    assert (imported, failed, len(sample)) == (3, 1, 1)
+    assert count_rows(app, user) == 3
+
+    # an interrupted import run again with the same upload
+    imported, failed, _ = app.import_csv_stream(Upload(CSV, 'upload-1'), user, None)
+    assert (imported, failed) == (0, 1)
+    assert count_rows(app, user) == 3
+
+    # another upload of the same file is a new import
+    imported, _, _ = app.import_csv_stream(Upload(CSV, 'upload-2'), user, None)
+    assert imported == 3
+    assert count_rows(app, user) == 6
+
+
+def test_resuming_an_interrupted_import_adds_only_the_missing_rows(app):
+    user = 'resume-user'
+    head = b"".join(CSV.splitlines(keepends=True)[:2])
+    assert app.import_csv_stream(Upload(head, 'upload-3'), user, None)[0] == 1
+    assert app.import_csv_stream(Upload(CSV, 'upload-3'), user, None)[0] == 2
+    assert count_rows(app, user) == 3
@@ -0,0 +1,52 @@
+import datetime
+import sqlite3
+
+import pytest
+
+TODAY = datetime.date.today()
+
+
+def day(offset):
+    return (TODAY + datetime.timedelta(days=offset)).isoformat()
+
+
+@pytest.fixture
+def board(app):
+    conn = sqlite3.connect(":memory:")
+    app.create_base_tables(conn)
+    app.ensure_rollups(conn)
+    board = app.RollingLeaderboard(window_days=7)
+    board.seed(conn, TODAY)
+    conn.close()
+    return board
+
+
+def test_window_rolls_over_to_the_new_day(app, board):
+    board.record([(1, day(-6), 'a', 5.0), (2, day(0), 'b', 3.0), (3, day(1), 'a', 1.0)])
+    assert board.top(today=TODAY) == [('b', 3.0), ('a', 5.0)]
+    # a day later the oldest bucket expires and the future-dated one counts
+    assert board.top(today=TODAY + datetime.timedelta(days=1)) == [('a', 1.0), ('b', 3.0)]
+    assert board.top(today=TODAY + datetime.timedelta(days=9)) == []
+
+
+def test_out_of_order_records_land_in_their_own_day(app, board):
+    board.record([(1, day(0), 'a', 4.0)])
+    board.record([(2, day(-3), 'a', 2.0), (3, day(-2), 'b', 1.0)])
+    board.record([(4, day(-10), 'b', 50.0), (5, None, 'b', 50.0), (6, day(-1), None, 50.0)])
+    assert board.top(today=TODAY) == [('b', 1.0), ('a', 6.0)]
+    # the backdated rows expire with their own day, not the day they were recorded on
+    assert board.top(today=TODAY + datetime.timedelta(days=4)) == [('b', 1.0), ('a', 4.0)]
+    assert board.top(today=TODAY + datetime.timedelta(days=5)) == [('a', 4.0)]
+
+
+def test_rows_counted_by_the_seed_are_not_counted_again(app):
+    conn = sqlite3.connect(":memory:")
+    app.create_base_tables(conn)
+    app.ensure_rollups(conn)
+    with conn:
+        conn.execute("INSERT INTO daily_emissions (alias, date, total_emission) VALUES ('a', ?, 2.0)", (day(0),))
+    board = app.RollingLeaderboard(window_days=7)
+    board.seed(conn, TODAY)
+    conn.close()
+    board.record([(1, day(0), 'a', 2.0), (2, day(0), 'a', 1.0)])
+    assert board.top(today=TODAY) == [('a', 3.0)]
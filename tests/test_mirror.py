@@ -0,0 +1,24 @@
+class FakeRepository:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def pages(self, filters, columns, after=0):
+        rows = [r for r in self.rows if r['id'] > after]
+        if rows:
+            yield rows
+
+
+def test_rows_with_bad_dates_are_skipped_and_the_cursor_advances(app):
+    rows = [
+        {'id': 1, 'user_id': 'mirror-user', 'date': '2024-03-01', 'total_emission': 1.0, 'idempotency_key': 'm1'},
+        {'id': 2, 'user_id': 'mirror-user', 'date': None, 'total_emission': 2.0, 'idempotency_key': 'm2'},
+        {'id': 3, 'user_id': 'mirror-user', 'date': '03/02/2024', 'total_emission': 3.0, 'idempotency_key': 'm3'},
+        {'id': 4, 'user_id': 'mirror-user', 'date': '2024-03-04T08:30:00+00:00', 'total_emission': 4.0, 'idempotency_key': None},
+    ]
+    assert app.sync_user_mirror('mirror-user', FakeRepository(rows)) == 2
+    stored = app.sqlite_conn.execute(
+        "SELECT date, idempotency_key FROM daily_emissions WHERE user_id = 'mirror-user' ORDER BY date"
+    ).fetchall()
+    assert stored == [('2024-03-01', 'm1'), ('2024-03-04', 'supabase:4')]
+    assert app.mirror_cursor(app.sqlite_conn, 'mirror-user') == 4
+    assert app.sync_user_mirror('mirror-user', FakeRepository(rows)) == 0
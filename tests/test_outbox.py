@@ -0,0 +1,101 @@
+import json
+
+import pytest
+
+
+class RejectedRow(Exception):
+    code = '23502'  # not_null_violation
+
+
+class FakeTable:
+    """Stands in for the Supabase client; rows whose distance is in bad are rejected."""
+    def __init__(self, bad=(), error=RejectedRow):
+        self.bad = set(bad)
+        self.error = error
+        self.calls = []
+        self.sent = []
+
+    def table(self, name):
+        return self
+
+    def upsert(self, rows, **kwargs):
+        self.rows = rows
+        return self
+
+    def execute(self):
+        self.calls.append(len(self.rows))
+        if any(r['distance'] in self.bad for r in self.rows):
+            raise self.error("rejected")
+        self.sent += [r['distance'] for r in self.rows]
+
+
+@pytest.fixture
+def outbox(app):
+    def fill(conn):
+        conn.execute("DELETE FROM supabase_outbox")
+        for n in range(5):
+            conn.execute(app.INSERT_OUTBOX_SQL, (f"key-{n}", json.dumps({'distance': n}), 0.0))
+    app.db_write(fill)
+    yield
+    app.db_write(lambda conn: conn.execute("DELETE FROM supabase_outbox"))
+
+
+def flush(app, client):
+    return app.flush_outbox_once(app.sqlite_conn, client, app.get_sqlite_writer())
+
+
+def make_due(app):
+    app.db_write(lambda conn: conn.execute("UPDATE supabase_outbox SET next_attempt_at = 0"))
+
+
+def test_delivered_rows_leave_the_outbox(app, outbox):
+    client = FakeTable()
+    assert flush(app, client) == 5
+    assert client.calls == [5]
+    assert app.outbox_pending_count() == 0
+
+
+def test_rejected_batch_is_resent_row_by_row(app, outbox):
+    client = FakeTable(bad={3})
+    assert flush(app, client) == 4
+    assert client.calls == [5, 1, 1, 1, 1, 1]
+    assert sorted(client.sent) == [0, 1, 2, 4]
+    assert app.sqlite_conn.execute("SELECT idempotency_key, attempts FROM supabase_outbox").fetchall() == [('key-3', 1)]
+
+
+def test_permanent_errors_mark_the_row_failed(app, outbox):
+    client = FakeTable(bad={3})
+    for _ in range(app.OUTBOX_MAX_ATTEMPTS):
+        flush(app, client)
+        make_due(app)
+    assert app.outbox_pending_count() == 0
+    assert app.outbox_failed_count() == 1
+    # failed rows are kept but never picked up again
+    assert flush(app, client) == 0
+
+
+def test_transient_errors_keep_retrying(app, outbox):
+    client = FakeTable(bad=set(range(5)), error=ConnectionError)
+    for _ in range(app.OUTBOX_MAX_ATTEMPTS + 1):
+        assert flush(app, client) == 0
+        make_due(app)
+    # a transient error fails the whole batch without a row-by-row resend
+    assert client.calls == [5] * (app.OUTBOX_MAX_ATTEMPTS + 1)
+    assert app.outbox_failed_count() == 0
+    assert app.outbox_pending_count() == 5
+
+
+def test_is_permanent_error(app):
+    class Response:
+        def __init__(self, status_code):
+            self.status_code = status_code
+
+    class HTTPError(Exception):
+        def __init__(self, status_code):
+            self.response = Response(status_code)
+
+    assert app.is_permanent_error(RejectedRow())
+    assert app.is_permanent_error(HTTPError(422))
+    assert not app.is_permanent_error(HTTPError(429))
+    assert not app.is_permanent_error(HTTPError(503))
+    assert not app.is_permanent_error(ConnectionError())
@@ -0,0 +1,3 @@
+def test_hot_queries_avoid_full_scans(app):
+    assert app.HOT_QUERIES
+    assert app.find_full_scans(app.sqlite_conn) == []
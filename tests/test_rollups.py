@@ -0,0 +1,9 @@
+def test_rows_without_a_readable_date_stay_out_of_the_rollups(app):
+    def insert(conn):
+        for date in (None, 'not a date', '2024-02-03T10:00:00'):
+            conn.execute("INSERT INTO daily_emissions (user_id, alias, date, total_emission) VALUES ('rollup-user', 'r', ?, 1.5)",
+                         (date,))
+    app.db_write(insert)
+    rows = app.sqlite_conn.execute("SELECT day, entries FROM rollup_user_daily WHERE user_key = 'rollup-user'").fetchall()
+    assert rows == [('2024-02-03', 1)]
+    assert app.sqlite_conn.execute("SELECT day FROM rollup_alias_daily WHERE alias = 'r'").fetchall() == [('2024-02-03',)]
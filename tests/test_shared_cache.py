@@ -0,0 +1,27 @@
+import pytest
+from streamlit.runtime.scriptrunner import StopException
+
+
+def test_stopped_refresh_does_not_block_later_callers(app):
+    cache = app.SharedResponseCache(ttl=60, wait_timeout=5)
+    pending = []
+
+    def stopped():
+        pending.append(cache._inflight['key'])
+        raise StopException()
+
+    with pytest.raises(StopException):
+        cache.get('key', stopped)
+    # callers that joined the stopped refresh get a plain error instead of hanging
+    assert isinstance(pending[0].exception(timeout=0), RuntimeError)
+    assert cache.get('key', lambda: 'fresh') == 'fresh'
+
+
+def test_entries_are_evicted_least_recently_used_first(app):
+    cache = app.SharedResponseCache(ttl=60, max_entries=2)
+    cache.get('a', lambda: 1)
+    cache.get('b', lambda: 2)
+    cache.get('a', lambda: 'unused')
+    cache.get('c', lambda: 3)
+    assert cache.get('a', lambda: 'recomputed') == 1
+    assert cache.get('b', lambda: 'recomputed') == 'recomputed'
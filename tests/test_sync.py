@@ -0,0 +1,47 @@
+import pytest
+
+
+@pytest.fixture
+def goals(app):
+    def reset(conn):
+        conn.execute("DELETE FROM user_goals")
+        conn.execute("DELETE FROM sync_changelog")
+        conn.execute("DELETE FROM supabase_mirror_state WHERE scope = 'pull:user_goals'")
+        conn.execute("INSERT INTO user_goals (user_id, weekly_target, updated_at, origin) VALUES ('u1', 20, 100.0, 'm')")
+    app.db_write(reset)
+    yield
+    app.db_write(reset)
+
+
+def apply(app, *rows, cursor=None):
+    app.db_write(app._apply_settings_job, 'user_goals', list(rows), cursor)
+    goal = app.sqlite_conn.execute("SELECT weekly_target FROM user_goals WHERE user_id = 'u1'").fetchone()[0]
+    queued = app.sqlite_conn.execute("SELECT row_key FROM sync_changelog").fetchall()
+    return goal, queued
+
+
+def remote(target, updated_at, origin):
+    return {'user_id': 'u1', 'weekly_target': target, 'updated_at': updated_at, 'origin': origin}
+
+
+def test_newer_remote_row_wins(app, goals):
+    assert apply(app, remote(30, 101.0, 'a')) == (30, [])
+
+
+def test_newer_local_row_is_queued_for_pushing(app, goals):
+    assert apply(app, remote(30, 99.5, 'z')) == (20, [('u1',)])
+
+
+def test_equal_timestamps_are_broken_by_origin(app, goals):
+    assert apply(app, remote(30, 100.0, 'a')) == (20, [('u1',)])
+    assert apply(app, remote(40, 100.0, 'z')) == (40, [('u1',)])
+
+
+def test_same_row_coming_back_is_not_requeued(app, goals):
+    assert apply(app, remote(20, 100.0, 'm')) == (20, [])
+
+
+def test_rows_for_new_users_are_inserted_and_cursor_advances(app, goals):
+    app.db_write(app._apply_settings_job, 'user_goals', [{**remote(15, 5.0, 'a'), 'user_id': 'u2'}], 7)
+    assert app.sqlite_conn.execute("SELECT weekly_target FROM user_goals WHERE user_id = 'u2'").fetchone() == (15,)
+    assert app.mirror_cursor(app.sqlite_conn, 'pull:user_goals') == 7
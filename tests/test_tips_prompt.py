@@ -0,0 +1,20 @@
+import pytest
+
+tiktoken = pytest.importorskip("tiktoken")
+
+
+def test_token_encoder_falls_back_to_estimates_when_no_encoding_loads(app, monkeypatch):
+    def unknown_model(model):
+        raise KeyError(model)
+
+    def offline(name):
+        raise ConnectionError("no network")
+
+    monkeypatch.setattr(tiktoken, "encoding_for_model", unknown_model)
+    monkeypatch.setattr(tiktoken, "get_encoding", offline)
+    app.token_encoder.clear()
+    try:
+        assert app.token_encoder() is None
+        assert app.count_tokens("12345678") == 2
+    finally:
+        app.token_encoder.clear()
@@ -0,0 +1,20 @@
+def test_reads_are_reused_until_the_user_writes(app):
+    user = 'versioned-user'
+    app.insert_local({'user_id': user, 'date': '2024-05-01', 'total_emission': 2.0})
+    assert app.emission_totals(user) == (2.0, 1)
+
+    # a write that skips the version bump is not seen: the cached totals are served
+    app.db_write(lambda conn: conn.execute(
+        "INSERT INTO daily_emissions (user_id, date, total_emission) VALUES (?, '2024-05-02', 3.0)", (user,)))
+    assert app.emission_totals(user) == (2.0, 1)
+
+    app.insert_local({'user_id': user, 'date': '2024-05-03', 'total_emission': 4.0})
+    assert app.emission_totals(user) == (9.0, 3)
+    assert app.emission_totals(None)[1] >= 3
+
+
+def test_version_is_per_user(app):
+    app.insert_local({'user_id': 'reader-a', 'date': '2024-05-01', 'total_emission': 1.0})
+    before = app.history_versions().version('reader-b')
+    app.insert_local({'user_id': 'reader-a', 'date': '2024-05-02', 'total_emission': 1.0})
+    assert app.history_versions().version('reader-b') == before